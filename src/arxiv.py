@@ -0,0 +1,63 @@
+from typing import Dict, List
+import xml.etree.ElementTree as ET
+
+from paper_registry import normalize_id, is_valid_id
+
+api_url = 'http://export.arxiv.org/api/query'
+atom = '{http://www.w3.org/2005/Atom}'
+
+session = None
+
+# All arxiv traffic goes through one pooled session so connections are reused
+def get_session():
+    global session
+    if session == None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return session
+
+class PaperMetadata:
+    id: str
+    title: str
+    abstract: str
+    pdf_url: str
+
+    def __init__(self, id: str, title: str, abstract: str, pdf_url: str):
+        self.id = id
+        self.title = title
+        self.abstract = abstract
+        self.pdf_url = pdf_url
+
+def fetch_metadata(ids: List[str], batch_size: int = 50) -> Dict[str, PaperMetadata]:
+    # One export api query covers a whole batch of ids instead of scraping each abs page
+    papers = {}
+    ids = list(dict.fromkeys([normalize_id(id) for id in ids]))
+    for id in ids:
+        if not is_valid_id(id):
+            print(f"Skipping {id}, it is not an arxiv id")
+    ids = [id for id in ids if is_valid_id(id)]
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        response = get_session().get(api_url, params={
+            'id_list': ','.join(batch),
+            'max_results': len(batch)
+        })
+        if response.status_code != 200:
+            print(f"Could not fetch metadata for {len(batch)} papers")
+            continue
+        feed = ET.fromstring(response.content)
+        for entry in feed.findall(atom + 'entry'):
+            id = normalize_id(entry.findtext(atom + 'id', ''))
+            title = ' '.join(entry.findtext(atom + 'title', '').split())
+            if id == '' or title == '' or title == 'Error':
+                continue
+            abstract = entry.findtext(atom + 'summary', '').strip()
+            pdf_url = f'https://arxiv.org/pdf/{id}.pdf'
+            for link in entry.findall(atom + 'link'):
+                if link.get('title') == 'pdf':
+                    pdf_url = link.get('href')
+            papers[id] = PaperMetadata(id, title, abstract, pdf_url)
+    return papers
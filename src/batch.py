@@ -0,0 +1,108 @@
+from typing import Callable, List
+import json
+import queue
+import threading
+import time
+
+from util import open_file
+
+# Decides which papers to read and what notes to read them with, so no one has to answer input()
+class ReadRules:
+    include: List[str]
+    exclude: List[str]
+    notes: str
+
+    def __init__(self, include: List[str] = [], exclude: List[str] = [], notes: str = ''):
+        self.include = [k.lower() for k in include]
+        self.exclude = [k.lower() for k in exclude]
+        self.notes = notes
+
+    @staticmethod
+    def from_file(path: str):
+        rules = json.loads(open_file(path))
+        return ReadRules(rules.get('include', []), rules.get('exclude', []), rules.get('notes', ''))
+
+    def accepts(self, title: str, abstract: str) -> bool:
+        text = (title + '\n' + abstract).lower()
+        if any([keyword in text for keyword in self.exclude]):
+            return False
+        if len(self.include) == 0:
+            return True
+        return any([keyword in text for keyword in self.include])
+
+# Append only list of progress events, a consumer polls with the offset it has read up to
+# and only gets what is new
+class ProgressLog:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def emit(self, event: str, id: str, text: str = ''):
+        with self.lock:
+            self.events.append({
+                "offset": len(self.events),
+                "time": time.time(),
+                "event": event,
+                "id": id,
+                "text": text
+            })
+        print(f'[{event}] {id} {text}')
+
+    def since(self, offset: int) -> List[dict]:
+        with self.lock:
+            return self.events[offset:]
+
+    def done(self) -> bool:
+        with self.lock:
+            return len(self.events) > 0 and self.events[-1]["event"] == 'finished'
+
+# Reads accepted papers with a pool of workers, each with its own researcher since
+# a researcher holds chat state
+class PaperQueue:
+    def __init__(self, new_researcher: Callable, workers: int = 4, log: ProgressLog = None):
+        self.new_researcher = new_researcher
+        self.workers = workers
+        self.log = log if log != None else ProgressLog()
+        self.researchers = []
+
+    def run(self, papers: list, rules: ReadRules, max_tokens: int = 30000) -> list:
+        jobs = queue.Queue()
+        results = [None] * len(papers)
+        for index, paper in enumerate(papers):
+            jobs.put((index, paper))
+            self.log.emit('queued', paper.id, paper.title)
+
+        def work():
+            researcher = self.new_researcher()
+            self.researchers.append(researcher)
+            while True:
+                try:
+                    index, paper = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                if not rules.accepts(paper.title, paper.abstract):
+                    self.log.emit('rejected', paper.id, paper.title)
+                    continue
+                self.log.emit('started', paper.id)
+                try:
+                    summary = researcher.read_paper(paper.id, max_tokens, metadata=paper, rules=rules)
+                except Exception as e:
+                    self.log.emit('failed', paper.id, str(e))
+                    continue
+                if summary == None:
+                    stored = researcher.registry.get(paper.id)
+                    if stored != None and stored['duplicate_of'] != None:
+                        self.log.emit('duplicate', paper.id, stored['duplicate_of'])
+                    else:
+                        self.log.emit('failed', paper.id)
+                    continue
+                results[index] = summary
+                self.log.emit('done', paper.id, summary.text)
+
+        threads = [threading.Thread(target=work) for _ in range(min(self.workers, len(papers)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.log.emit('finished', '', f'{len([r for r in results if r != None])} of {len(papers)} papers read')
+        return [r for r in results if r != None]
@@ -0,0 +1,397 @@
+# Runs the pipelines against local stand-ins for OpenAI, Reddit, arxiv and Medium
+# so they can be timed without credentials:
+#   python benchmark.py [news|research|read_paper|all] [--quick] [--latency 0.05]
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from types import SimpleNamespace
+from typing import List
+import asyncio
+import builtins
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import openai
+
+import arxiv
+import gpt
+import rate_limit
+import reddit_reader
+from bots import Bot, Editor, Researcher
+from completion_log import CompletionLog
+from pdf_reader import PaperTextStore
+from reddit import PostReader
+
+# Big enough that two random texts share almost no shingles, so dedup keeps them apart
+words = [prefix + word for prefix in ['', 'pre', 're', 'sub', 'co', 'multi', 'over', 'non']
+    for word in 'model token paper result method training data network layer loss attention learning'.split()]
+
+def sentence(rng: random.Random, length: int) -> str:
+    return ' '.join([rng.choice(words) for _ in range(length)]).capitalize() + '.'
+
+# Counts everything the fakes are asked to do
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self.stages = {}
+
+    def add(self, name: str, amount: float = 1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def add_stage(self, name: str, seconds: float):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+counters = Counters()
+
+# Wraps a method so the time spent in it is added to a stage, nested stages are inclusive
+def time_stage(cls, method: str, stage: str):
+    original = getattr(cls, method)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            counters.add_stage(stage, time.perf_counter() - start)
+    setattr(cls, method, timed)
+
+class FakeChatCompletion:
+    latency = 0.05
+    response_tokens = 300
+
+    @classmethod
+    def response(cls, config: dict):
+        prompt_tokens = sum([len(m['content']) for m in config['messages']]) // 4
+        completion_tokens = min(config['max_tokens'], cls.response_tokens)
+        counters.add('openai_calls')
+        counters.add('prompt_tokens', prompt_tokens)
+        counters.add('completion_tokens', completion_tokens)
+        counters.add_stage('openai', cls.latency)
+        content = ' '.join(['summary'] * completion_tokens)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens
+            )
+        )
+
+    @classmethod
+    def create(cls, **config):
+        time.sleep(cls.latency)
+        return cls.response(config)
+
+    @classmethod
+    async def acreate(cls, **config):
+        await asyncio.sleep(cls.latency)
+        return cls.response(config)
+
+class FakeComment:
+    def __init__(self, rng: random.Random):
+        self.author = f'user{rng.randint(0, 10000)}'
+        self.body = ' '.join([sentence(rng, rng.randint(5, 20)) for _ in range(rng.randint(1, 4))])
+        self.score = rng.randint(0, 5000)
+
+# Named like praw's placeholder so the editor can tell it apart from a comment
+class MoreComments:
+    pass
+
+class FakeCommentForest:
+    latency = 0.02
+
+    def __init__(self, rng: random.Random, loaded: int, more: int):
+        self.rng = rng
+        self.comments = [FakeComment(rng) for _ in range(loaded)]
+        self.more = more
+
+    def replace_more(self, limit=32, threshold=0):
+        expansions = self.more if limit == None else min(limit, self.more)
+        for _ in range(expansions):
+            time.sleep(self.latency)
+            counters.add('reddit_calls')
+            self.comments += [FakeComment(self.rng) for _ in range(20)]
+        self.more -= expansions
+        return [MoreComments() for _ in range(self.more)]
+
+    def list(self):
+        return self.comments + [MoreComments() for _ in range(self.more)]
+
+def paper_id(index: int) -> str:
+    return f'{2300 + index // 10000}.{index % 10000:05d}'
+
+class FakeSubmission:
+    def __init__(self, rng: random.Random, index: int, papers: bool):
+        self.permalink = f'/r/bench/comments/{index}/post_{index}/'
+        self.url = f'https://www.reddit.com{self.permalink}'
+        self.title = sentence(rng, 8)
+        self.selftext = ' '.join([sentence(rng, 15) for _ in range(rng.randint(1, 20))])
+        if papers:
+            self.selftext += f' https://arxiv.org/abs/{paper_id(index)}'
+        self.id = f'bench{index}'
+        self.score = rng.randint(0, 50000)
+        self.edited = False
+        self.comments = FakeCommentForest(rng, rng.randint(0, 50), rng.randint(0, 20))
+        self.num_comments = len(self.comments.comments) + self.comments.more * 20
+
+class FakeSubreddit:
+    def __init__(self, reddit, name: str):
+        self.reddit = reddit
+        self.name = name
+
+    def hot(self, limit=100):
+        counters.add('reddit_calls', max(1, (limit + 99) // 100))
+        rng = random.Random(self.name)
+        for index in range(limit):
+            yield FakeSubmission(rng, index, self.reddit.papers)
+
+class FakeReddit:
+    def __init__(self, papers: bool = False):
+        # With papers every post links to an arxiv paper
+        self.papers = papers
+
+    def subreddit(self, name: str):
+        return FakeSubreddit(self, name)
+
+class FakeMedium:
+    def __init__(self, access_token: str = ''):
+        pass
+
+    def get_current_user(self):
+        counters.add('medium_calls')
+        return {'id': 'bench'}
+
+    def create_post(self, user_id, title, content, content_format, publish_status):
+        counters.add('medium_calls')
+        return {'url': 'https://medium.com/bench', 'id': 'bench'}
+
+def make_pdf(pages: int, seed: int | str = 0) -> bytes:
+    # Writes a minimal pdf by hand, each page with a few hundred words PyPDF2 can extract
+    rng = random.Random(seed)
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for _ in range(pages):
+        lines = [sentence(rng, 12) for _ in range(40)]
+        stream = 'BT /F1 10 Tf 50 750 Td 14 TL ' + ' '.join([f'({line}) Tj T*' for line in lines]) + ' ET'
+        stream = stream.encode('latin-1')
+        content_id = len(objects) + 2
+        kids.append(f'{len(objects) + 1} 0 R')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>'.encode())
+        objects.append(b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {pages} >>'.encode()
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for index, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += f'{index + 1} 0 obj\n'.encode() + obj + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        pdf += f'{offset:010d} 00000 n \n'.encode()
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return pdf
+
+# A 500 page pdf takes about a second to build, they are all written out before anything is measured
+def write_pdfs(directory: str, pages: int, ids: List[str]):
+    os.makedirs(directory, exist_ok=True)
+    for id in ids:
+        path = os.path.join(directory, f'{id}.pdf')
+        if not os.path.exists(path):
+            # Every paper gets its own text, identical pdfs would all be collapsed as duplicates
+            with open(path, 'wb') as f:
+                f.write(make_pdf(pages, id))
+
+# Serves the export api for any id and the pdfs already written to the server's directory
+class ArxivHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        counters.add('arxiv_calls')
+        url = urlparse(self.path)
+        host = f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+        if url.path == '/api/query':
+            ids = parse_qs(url.query)['id_list'][0].split(',')
+            entries = ''.join([f'''
+                <entry>
+                    <id>http://arxiv.org/abs/{id}v1</id>
+                    <title>Benchmark paper {id}</title>
+                    <summary>{sentence(random.Random(id), 80)}</summary>
+                    <link title="pdf" href="{host}/pdf/{id}.pdf"/>
+                </entry>''' for id in ids])
+            body = f'<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom">{entries}</feed>'.encode()
+            content_type = 'application/atom+xml'
+        elif url.path.startswith('/pdf/') and os.path.exists(self.pdf_path(url.path)):
+            # Copied straight from disk so the benchmarked process never holds a whole pdf for the server
+            path = self.pdf_path(url.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+            return
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def pdf_path(self, path: str) -> str:
+        return os.path.join(self.server.pdf_dir, os.path.basename(path))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_arxiv_server(pdf_dir: str) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArxivHandler)
+    server.pdf_dir = pdf_dir
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    arxiv.api_url = f'http://127.0.0.1:{server.server_address[1]}/api/query'
+    return server
+
+lifted_limits = {}
+
+def install_fakes():
+    openai.ChatCompletion = FakeChatCompletion
+    reddit_reader.RedditNews.new_medium_client = lambda self: FakeMedium()
+    gpt.cache.enabled = False
+    # The fakes can take any rate, the limiters would only measure themselves. The reddit
+    # limiter keeps its real burst so one run can put it back
+    for limiter in [rate_limit.reddit_limiter, rate_limit.openai_limiter, rate_limit.openai_token_limiter]:
+        lifted_limits[limiter] = limiter.capacity
+        limiter.capacity = limiter.tokens = float('inf')
+    gpt.completion_log = CompletionLog(os.devnull)
+    builtins.input = lambda prompt='': 'yes' if 'Read' in prompt else ''
+    time_stage(PostReader, 'get_posts', 'reddit_fetch')
+    time_stage(Editor, 'harvest_comments', 'comment_expansion')
+    time_stage(Editor, 'fetch_posts', 'build_prompts')
+    time_stage(Bot, 'complete_promts', 'complete_prompts')
+    time_stage(Researcher, 'discover_papers', 'discover_papers')
+    time_stage(PaperTextStore, 'extract', 'pdf_extract')
+    time_stage(reddit_reader.RedditNews, 'post_to_medium', 'medium_publish')
+
+def new_news(reddit: FakeReddit, workdir: str) -> reddit_reader.RedditNews:
+    os.makedirs(workdir, exist_ok=True)
+    # Every store is built inside the work directory, nothing next to the checkout is touched
+    news = reddit_reader.RedditNews('bench', 'bench', reddit, data_dir=workdir)
+    return news
+
+# Runs the pipeline from a fresh work directory twice, so nothing is read from a previous run.
+# tracemalloc slows every allocation down, the timed pass runs without it and memory gets its own pass
+def measure(name: str, scale: str, setup) -> dict:
+    result = {'pipeline': name, 'scale': scale}
+    for traced in [False, True]:
+        workdir = tempfile.mkdtemp(prefix='reddit_news_bench_')
+        try:
+            run = setup(workdir)
+            counters.reset()
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            run()
+            wall = time.perf_counter() - start
+            if traced:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                result['peak_mb'] = peak / 1024 / 1024
+            else:
+                result['wall'] = wall
+                result['counts'] = dict(counters.values)
+                result['stages'] = dict(counters.stages)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_result(result)
+    return result
+
+def print_result(result: dict):
+    counts = result['counts']
+    print(f"\n{result['pipeline']} ({result['scale']}): {result['wall']:.2f}s wall, {result['peak_mb']:.1f} MB peak")
+    print(f"  openai calls: {counts.get('openai_calls', 0):.0f}, reddit calls: {counts.get('reddit_calls', 0):.0f}, "
+        f"arxiv calls: {counts.get('arxiv_calls', 0):.0f}, medium calls: {counts.get('medium_calls', 0):.0f}")
+    print(f"  tokens: {counts.get('prompt_tokens', 0):.0f} prompt, {counts.get('completion_tokens', 0):.0f} completion")
+    for stage, seconds in sorted(result['stages'].items(), key=lambda s: s[1], reverse=True):
+        print(f"  {stage:<20} {seconds:8.2f}s")
+
+def bench_news(posts: int) -> dict:
+    def setup(workdir: str):
+        news = new_news(FakeReddit(), workdir)
+        return lambda: news.create_news_article('bench', posts)
+    return measure('news', f'{posts} posts', setup)
+
+def bench_news_limited(posts: int) -> dict:
+    # Same run with the real reddit limiter, pacing that costs wall time shows up here
+    limiter = rate_limit.reddit_limiter
+    def setup(workdir: str):
+        limiter.capacity = limiter.tokens = lifted_limits[limiter]
+        news = new_news(FakeReddit(), workdir)
+        return lambda: news.create_news_article('bench', posts)
+    try:
+        return measure('news (reddit limiter)', f'{posts} posts', setup)
+    finally:
+        limiter.capacity = limiter.tokens = float('inf')
+
+def bench_research(posts: int, pages: int, pdf_dir: str) -> dict:
+    write_pdfs(pdf_dir, pages, [paper_id(index) for index in range(posts)])
+    server = start_arxiv_server(pdf_dir)
+    def setup(workdir: str):
+        news = new_news(FakeReddit(papers=True), workdir)
+        return lambda: news.find_papers('bench', posts)
+    try:
+        return measure('research', f'{posts} posts, {pages} pages', setup)
+    finally:
+        server.shutdown()
+
+def bench_read_paper(pages: int, strategy: str, pdf_dir: str) -> dict:
+    write_pdfs(pdf_dir, pages, ['2301.00001'])
+    server = start_arxiv_server(pdf_dir)
+    def setup(workdir: str):
+        researcher = new_news(FakeReddit(), workdir).researcher
+        return lambda: researcher.read_paper('2301.00001', max_tokens=10**9, strategy=strategy)
+    try:
+        return measure(f'read_paper {strategy}', f'{pages} pages', setup)
+    finally:
+        server.shutdown()
+
+def main(args: list):
+    command = args[0] if len(args) > 0 and not args[0].startswith('--') else 'all'
+    if '--latency' in args:
+        FakeChatCompletion.latency = float(args[args.index('--latency') + 1])
+    post_scales = [10, 100] if '--quick' in args else [10, 100, 1000]
+    page_scales = [10, 50] if '--quick' in args else [10, 100, 500]
+
+    install_fakes()
+    results = []
+    # One directory of pdfs per page count, shared by every run at that count
+    pdf_root = tempfile.mkdtemp(prefix='reddit_news_bench_pdfs_')
+    try:
+        for scale in post_scales:
+            for pages in page_scales:
+                pdf_dir = os.path.join(pdf_root, str(pages))
+                if command in ['news', 'all'] and pages == page_scales[0]:
+                    results.append(bench_news(scale))
+                    if scale == post_scales[0]:
+                        results.append(bench_news_limited(scale))
+                if command in ['research', 'all']:
+                    results.append(bench_research(scale, pages, pdf_dir))
+                if command in ['read_paper', 'all'] and scale == post_scales[0]:
+                    for strategy in ['serial', 'map_reduce']:
+                        results.append(bench_read_paper(pages, strategy, pdf_dir))
+    finally:
+        shutil.rmtree(pdf_root, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
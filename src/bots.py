@@ -1,36 +1,45 @@
 from urllib.parse import urlparse
-from typing import List
-import requests
+from typing import Deque, List
 import re
-import os
-import io
-from bs4 import BeautifulSoup
-
-import PyPDF2
+import asyncio
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 from gpt import GptChat
 from reddit import PostReader
-from util import open_file
-from objects import Prompt, Conversation, Summary
+from pdf_reader import PaperTextStore
+from arxiv import PaperMetadata, fetch_metadata, get_session
+from paper_registry import PaperRegistry, normalize_id, is_valid_id
+from batch import ReadRules
+from packer import ContextPacker
+from checkpoint import CheckpointStore
+from dedup import DuplicateIndex, simhash, token_features
+from objects import Prompt, Conversation, Summary, Message, RedditPost
+from telemetry import telemetry
+from rate_limit import reddit_limiter
+
+post_separator = '\nEND_POST\nBEGIN_COMMENTS:\n'
 
 class Bot(GptChat):
     post_reader: PostReader
-    conversations: List[Conversation]
+    conversations: Deque[Conversation]
 
     def __init__(self, pr: PostReader, prompt_file: str):
         super().__init__(prompt_file)
         self.post_reader = pr
         self.completions = []
 
-    def complete_promts(self, prompts: List[Prompt]) -> List[Summary]:
+    def complete_promts(self, prompts: List[Prompt], concurrency: int = 1) -> List[Summary]:
+        if concurrency > 1:
+            return asyncio.run(self.complete_promts_async(prompts, concurrency))
         summaries = []
         for prompt in prompts:
             print('\nPost:')
             print(prompt.url)
 
             self.reset_chat()
-            summary = self.send(prompt.text)
-            summaries.append(Summary(prompt.title, prompt.url, summary))
+            summary = self.send(prompt.text, prompt.response_tokens)
+            summaries.append(Summary(prompt.title, summary, prompt.url))
             
             print(summary)
             print('\n\n')
@@ -38,60 +47,158 @@ class Bot(GptChat):
         self.reset_chat()
         return summaries
 
+    async def complete_promts_async(self, prompts: List[Prompt], concurrency: int = 5) -> List[Summary]:
+        # Every prompt is independent, so send them all with at most `concurrency` in flight
+        self.reset_chat()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def complete(prompt: Prompt) -> Conversation:
+            async with semaphore:
+                return await self.send_async(prompt.text, prompt.response_tokens)
+
+        conversations = await asyncio.gather(*[complete(prompt) for prompt in prompts])
+
+        summaries = []
+        for prompt, conversation in zip(prompts, conversations):
+            summary = conversation.messages[-1].content
+            self.close_conversation(conversation)
+            summaries.append(Summary(prompt.title, summary, prompt.url))
+
+            print('\nPost:')
+            print(prompt.url)
+            print(summary)
+            print('\n\n')
+        return summaries
+
 class ReaserchSummarizer(Bot):
+    speaker = 'Summarizer'
+
     def __init__(self, pr: PostReader):
         super().__init__(pr, 'research_summarizer')
 
-    def summarize_chunk_list(self, overall_summary = '', list = [], note = ''):
-        if len(list) == 0:
-            return ''
-        self.reset_chat()
-        print('Creating overall summary:')
+    def intro_messages(self, overall_summary = '', note = '') -> List[Message]:
+        # Everything sent ahead of the summaries themselves
+        messages = []
         if len(note) > 0:
-            self.add_message('Please keep this note in mind:\n' + note, 'user')
-            self.add_message('Ok, I\' keep that in mind', 'assistant')
+            messages.append(self.new_message('Please keep this note in mind:\n' + note, 'user'))
+            messages.append(self.new_message('Ok, I\' keep that in mind', 'assistant'))
         if len(overall_summary) > 0:
-            print(f'Overall summary is {len(self.encoding.encode(overall_summary))} tokens')
-            self.add_message('What is the summary overall?', 'user')
-            self.add_message(overall_summary, 'assistant')
-        self.add_message('Ok, I\'m now going to give you the new notes', 'user')
-        self.add_message('Ok, I\'m ready for the new notes', 'assistant')
+            messages.append(self.new_message('What is the summary overall?', 'user'))
+            messages.append(self.new_message(overall_summary, 'assistant'))
+            print(f'Overall summary is {messages[-1].tokens} tokens')
+        messages.append(self.new_message('Ok, I\'m now going to give you the new notes', 'user'))
+        messages.append(self.new_message('Ok, I\'m ready for the new notes', 'assistant'))
+        return messages
+
+    def chunk_list_messages(self, overall_summary = '', list = [], note = '') -> List[Message]:
+        messages = self.intro_messages(overall_summary, note)
         total_summary_tokens = 0
         for summary in list:
-            current_summary_tokens = len(self.encoding.encode(summary))
+            messages.append(self.new_message(summary, 'user'))
+            current_summary_tokens = messages[-1].tokens
             print(f'Summary is {current_summary_tokens} tokens')
             total_summary_tokens += current_summary_tokens
-            self.add_message(summary, 'user')
-            self.add_message('Ok, I\'m ready for the next note', 'assistant')
+            messages.append(self.new_message('Ok, I\'m ready for the next note', 'assistant'))
         print(f'All Summaries are {total_summary_tokens} tokens')
+        return messages
+
+    def summarize_chunk_list(self, overall_summary = '', list = [], note = ''):
+        if len(list) == 0:
+            return ''
+        self.reset_chat()
+        print('Creating overall summary:')
+        for m in self.chunk_list_messages(overall_summary, list, note):
+            self.messages.append(m)
+            self.message_tokens += m.tokens
         return self.send('That is all the summaries, what is the new overall summary?', 700)
 
+    async def summarize_chunk_list_async(self, list = [], note = '') -> str:
+        if len(list) == 1:
+            return list[0]
+        print('Creating overall summary:')
+        history = self.chunk_list_messages('', list, note)
+        conversation = await self.send_async('That is all the summaries, what is the new overall summary?', 700, history)
+        self.close_conversation(conversation)
+        return conversation.messages[-1].content
+
+    def group_summaries(self, summaries: List[str], note = '', message_overhead: int = 4, margin: int = 50) -> List[List[str]]:
+        # Pack as many summaries into each merge call as the context window allows. On top of its
+        # content every message costs a few tokens the api adds, and each summary is two messages
+        fixed_messages = [self.new_message(self.system_prompt, 'system')] + self.intro_messages('', note)
+        fixed_messages.append(self.new_message('That is all the summaries, what is the new overall summary?', 'user'))
+        budget = self.context_window - 700 - margin
+        budget -= sum([m.tokens + message_overhead for m in fixed_messages])
+        ack_tokens = self.new_message('Ok, I\'m ready for the next note', 'assistant').tokens
+
+        groups = [[]]
+        group_tokens = 0
+        for summary in summaries:
+            tokens = len(self.encoding.encode(summary)) + ack_tokens + 2 * message_overhead
+            if len(groups[-1]) >= 2 and group_tokens + tokens > budget:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(summary)
+            group_tokens += tokens
+        return groups
+
 class Researcher(Bot):
-    def __init__(self, pr: PostReader):
+    speaker = 'Researcher'
+
+    # data_dir holds the pdf store, checkpoints, registry and duplicate index. Researchers
+    # working side by side can share one paper_text store and its download pool
+    def __init__(self, pr: PostReader, data_dir: str = '..', paper_text: PaperTextStore | None = None):
         super().__init__(pr, 'researcher')
         self.summarizer = ReaserchSummarizer(pr)
+        self.paper_text = paper_text if paper_text != None else PaperTextStore(f'{data_dir}/papers', get_session())
+        self.registry = PaperRegistry(f'{data_dir}/papers.db', [f'{data_dir}/arvix_papers.txt', f'{data_dir}/arxiv_papers.txt'])
+        self.packer = ContextPacker(self.encoding, self.context_window)
+        self.checkpoints = CheckpointStore(f'{data_dir}/papers')
+        self.duplicates = DuplicateIndex(f'{data_dir}/duplicates.db')
+        # Papers skipped as near duplicates, keyed by the title and url of the paper they duplicate
+        self.collapsed_papers = {}
+
+    def set_model(self, model: str, context_window: int):
+        # Larger context models let each call read more of the paper
+        for bot in [self, self.summarizer]:
+            bot.model = model
+            bot.context_window = context_window
+        self.packer.context_window = context_window
+
+    def set_stream(self, stream: bool):
+        # Only worth it when one paper is read at a time, the summaries of parallel reads would interleave
+        for bot in [self, self.summarizer]:
+            bot.stream = stream
     
     def fetch_arxiv(self, subreddit, limit=10, max_tokens=10000) -> List[Summary]:
+        ret_posts = [ ]
+        for paper in self.discover_papers(subreddit, limit):
+            summary = self.read_paper(paper.id, max_tokens, metadata=paper)
+            if summary == None:
+                continue
+            ret_posts.append(summary)
+        self.report_duplicates()
+        return ret_posts
+
+    def report_duplicates(self):
+        self.duplicates.report(self.collapsed_papers)
+        self.collapsed_papers = {}
+
+    def discover_papers(self, subreddit, limit=10) -> List[PaperMetadata]:
         def cleanup_link(link):
             # Remove trailing characters like parentheses, brackets, and periods
             link = re.sub(r'[\)\]\.]+$', '', link)
             return link
 
-        papers_file = '../arxiv_papers.txt'
-        read_papers = []
-        if os.path.exists(papers_file):
-            read_papers = open_file(papers_file).split('\n')
-        ret_posts = [ ]
-
         print("Fetching posts...")
-        posts = self.post_reader.get_posts(subreddit, 100)
+        posts = self.post_reader.get_posts(subreddit, limit)
         print("Posts fetched")
         arxiv_pattern = re.compile(r'(https?:\/\/arxiv\.org\/[^\s\)\]]+)')
+        paper_ids = []
         for post in posts:
             paper_urls = []
             url_domain = urlparse(post.url).netloc
-            if url_domain == 'arxiv' or url_domain == 'www.arxiv':
-                paper_urls = post.url
+            if url_domain == 'arxiv.org' or url_domain == 'www.arxiv.org':
+                paper_urls.append(post.url)
             for match in arxiv_pattern.finditer(post.body):
                 paper_urls.append(cleanup_link(post.body[match.start():match.end()]))
 
@@ -101,55 +208,128 @@ class Researcher(Bot):
 
             for url in paper_urls:
                 print(url)
-                id = url.split("/")[-1]
-                if id in read_papers:
+                id = normalize_id(url)
+                if not is_valid_id(id):
+                    print(f'Skipping {url}, it is not a paper')
                     continue
-                print('Found paper id: ' + id)
-                summary = self.read_paper(id, max_tokens)
-                if summary == None:
+                if id in paper_ids or self.registry.has(id):
                     continue
-                ret_posts.append(summary)
-        return ret_posts
+                print('Found paper id: ' + id)
+                paper_ids.append(id)
+
+        print(f"Fetching metadata for {len(paper_ids)} papers")
+        papers = fetch_metadata(paper_ids)
+        # Download every pdf in the background while the abstracts are reviewed
+        for paper in papers.values():
+            self.paper_text.prefetch(paper.id, paper.pdf_url)
 
-    def read_paper(self, id: str, max_tokens: int = 30000, chunk_size: int = 2500) -> Summary | None:
-        abs_url = f'https://arxiv.org/abs/{id}'
-        response = requests.get(abs_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        print(f'Name: {soup.title.string}')
-        abstract_elem = soup.find('blockquote', {'class': 'abstract'})
-        print(abstract_elem.text)
-        should_read = input('Read paper?: ')
-        if should_read.lower() != 'yes':
+        for id in paper_ids:
+            if id not in papers:
+                print(f"Could not find paper {id}")
+        return [papers[id] for id in paper_ids if id in papers]
+
+    def read_paper(self, id: str, max_tokens: int = 30000, chunk_size: int | None = None, strategy: str = 'serial', metadata: PaperMetadata | None = None, rules: ReadRules | None = None) -> Summary | None:
+        id = normalize_id(id)
+        paper = self.registry.get(id)
+        if paper != None and paper['duplicate_of'] != None:
+            print(f"Paper {id} is a near duplicate of {paper['duplicate_of']}, skipping")
             return None
+        if paper != None and paper['summary'] != None:
+            print(f"Using stored summary for paper {id}")
+            return Summary(paper['title'], paper['summary'], paper['pdf_url'])
 
-        print("Downloading pdf")
-        pdf_url = f'https://arxiv.org/pdf/{id}.pdf'
-        response = requests.get(pdf_url)
-        if response.status_code != 200:
-            print("Could not find pdf for paper")
+        checkpoint = self.checkpoints.load(id)
+        if checkpoint != None and checkpoint['strategy'] == strategy and checkpoint['chunk_size'] == chunk_size:
+            # The paper was already accepted and its notes given, carry on from the last finished chunk
+            print(f"Resuming paper {id} from checkpoint")
+            metadata = PaperMetadata(id, checkpoint['title'], '', checkpoint['pdf_url'])
+            notes = checkpoint['notes']
+        else:
+            checkpoint = None
+            if metadata == None:
+                metadata = fetch_metadata([id]).get(id)
+                if metadata == None:
+                    print(f"Could not find paper {id}")
+                    return None
+            print(f'Name: {metadata.title}')
+            print(metadata.abstract)
+            if rules != None:
+                if not rules.accepts(metadata.title, metadata.abstract):
+                    print('Paper rejected by rules')
+                    return None
+            else:
+                should_read = input('Read paper?: ')
+                if should_read.lower() != 'yes':
+                    return None
+
+        pdf_url = metadata.pdf_url
+        tokens = self.paper_text.extract(id, pdf_url, self.encoding, max_tokens)
+        if tokens == None:
+            return None
+        # The same paper posted under another id is only summarized and published once
+        signature = simhash(token_features(tokens))
+        duplicate = self.duplicates.find('paper', id, signature)
+        if duplicate != None:
+            print(f"Paper {id} is a near duplicate of {duplicate['key']}, skipping")
+            self.registry.record_duplicate(id, duplicate['key'], metadata.title, pdf_url)
+            self.checkpoints.clear(id)
+            group = self.collapsed_papers.setdefault((duplicate['title'], duplicate['url']), [])
+            group.append(Summary(metadata.title, '', pdf_url))
             return None
-        pdfReader = PyPDF2.PdfReader(io.BytesIO(response.content))
-        print('What should I keep in mind while reading the paper? (leave blank if no notes)')
-        notes = input('Notes: ')
-        text = ''
-        print(f"Paper has {len(pdfReader.pages)} pages")
-        for page_num in range(0, len(pdfReader.pages)):
-            page = pdfReader.pages[page_num].extract_text()
-            text += ' ' + page
-        tokens = self.encoding.encode(text)
+        if checkpoint == None:
+            if rules != None:
+                notes = rules.notes
+            else:
+                print('What should I keep in mind while reading the paper? (leave blank if no notes)')
+                notes = input('Notes: ')
         total_tokens = len(tokens)
-        print(f"Paper has {len(tokens)} tokens")
-        if len(tokens) > max_tokens:
-            tokens = tokens[:max_tokens]
+        print(f"Reading {total_tokens} tokens of paper")
+        tokens_before = self.total_tokens + self.summarizer.total_tokens
+        previous_tokens = checkpoint['tokens_used'] if checkpoint != None else 0
+
+        def save_progress(progress: dict):
+            self.checkpoints.save(id, {
+                "strategy": strategy,
+                "chunk_size": chunk_size,
+                "title": metadata.title,
+                "pdf_url": pdf_url,
+                "notes": notes,
+                "tokens_used": previous_tokens + self.total_tokens + self.summarizer.total_tokens - tokens_before,
+                **progress
+            })
+
+        if strategy == 'map_reduce':
+            overall_summary = asyncio.run(self.summarize_map_reduce(tokens, chunk_size, notes, save_progress, checkpoint))
+        else:
+            overall_summary = self.summarize_serial(tokens, chunk_size, notes, total_tokens, save_progress, checkpoint)
+        self.reset_chat()
+        tokens_used = previous_tokens + self.total_tokens + self.summarizer.total_tokens - tokens_before
+        self.registry.record(id, metadata.title, pdf_url, overall_summary, tokens_used)
+        self.duplicates.add('paper', id, signature, metadata.title, pdf_url)
+        self.checkpoints.clear(id)
+        return Summary(metadata.title, overall_summary, pdf_url)
+
+    def summarize_serial(self, tokens, chunk_size, notes, total_tokens, save_progress = None, checkpoint: dict | None = None) -> str:
         first = False
         processed_tokens = 0
         summary_list = []
         last_summary = ''
         overall_summary = ''
-        while len(tokens) > 0:
-            chunk = tokens[:chunk_size]
-            tokens = tokens[chunk_size:]
-            last_summary = self.read_chunk(overall_summary, chunk, first, notes)
+        if checkpoint != None:
+            processed_tokens = checkpoint['offset']
+            summary_list = checkpoint['summary_list']
+            overall_summary = checkpoint['overall_summary']
+            print(f"Resuming at {processed_tokens} of {total_tokens} tokens")
+        while processed_tokens < len(tokens):
+            if chunk_size == None:
+                # Packs as much of the paper as fits next to the notes and the summary so far
+                self.prepare_chunk_chat(overall_summary, first, notes)
+                chunk, processed_tokens = self.packer.next_chunk(tokens, processed_tokens, self.get_message_tokens())
+                last_summary = self.send(self.encoding.decode(chunk), self.packer.response_tokens)
+            else:
+                chunk = tokens[processed_tokens:processed_tokens + chunk_size]
+                processed_tokens += chunk_size
+                last_summary = self.read_chunk(overall_summary, chunk, first, notes)
             summary_list.append(last_summary)
             if len(summary_list) > 4:
                 summary_list = summary_list[1:5]
@@ -159,19 +339,70 @@ class Researcher(Bot):
                 overall_summary = last_summary
             print(f'\n\n\nOverall Summary:{overall_summary}\n\n\n')
             print(f'\n\n\nCurrent Summary:{last_summary}\n\n\n')
-            processed_tokens += chunk_size
-            print(f"Processed {processed_tokens} of {total_tokens} tokens")
-        self.reset_chat()
-        with open('../arvix_papers.txt', 'a') as f:
-            f.write(id + '\n')
-        return Summary(soup.title.string, overall_summary, pdf_url)
-    
+            print(f"Processed {min(processed_tokens, total_tokens)} of {total_tokens} tokens")
+            if save_progress != None:
+                save_progress({
+                    "offset": processed_tokens,
+                    "summary_list": summary_list,
+                    "overall_summary": overall_summary
+                })
+        return overall_summary
+
+    async def summarize_map_reduce(self, tokens, chunk_size, notes, save_progress = None, checkpoint: dict | None = None, concurrency: int = 5) -> str:
+        # Summarize every chunk on its own (map), then merge the summaries in a tree (reduce)
+        semaphore = asyncio.Semaphore(concurrency)
+        # Keyed by chunk index as a string so it survives the trip through json
+        chunk_summaries = checkpoint['chunk_summaries'] if checkpoint != None else {}
+
+        async def read(index, chunk):
+            if str(index) in chunk_summaries:
+                return chunk_summaries[str(index)]
+            async with semaphore:
+                summary = await self.read_chunk_async(chunk, notes)
+            chunk_summaries[str(index)] = summary
+            if save_progress != None:
+                save_progress({ "chunk_summaries": chunk_summaries })
+            return summary
+
+        async def merge(group):
+            async with semaphore:
+                return await self.summarizer.summarize_chunk_list_async(group, notes)
+
+        if chunk_size == None:
+            used_tokens = self.system_prompt_tokens + sum([m.tokens for m in self.note_messages(notes)])
+            chunks = self.packer.split(tokens, used_tokens)
+        else:
+            chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+        print(f"Reading {len(chunks)} chunks")
+        summaries = await asyncio.gather(*[read(index, chunk) for index, chunk in enumerate(chunks)])
+        level = 0
+        while len(summaries) > 1:
+            level += 1
+            groups = self.summarizer.group_summaries(summaries, notes)
+            print(f"Merging {len(summaries)} summaries into {len(groups)} at level {level}")
+            summaries = await asyncio.gather(*[merge(group) for group in groups])
+        if len(summaries) == 0:
+            return ''
+        print(f'\n\n\nOverall Summary:{summaries[0]}\n\n\n')
+        return summaries[0]
+
+    def note_messages(self, notes) -> List[Message]:
+        if notes == '':
+            return []
+        return [
+            self.new_message(f'Keep in mind this note:\n{notes}', 'user'),
+            self.new_message('Ok, I\'ll keep that in mind', 'assistant')
+        ]
+
     def read_chunk(self, current_summary, chunk, first, notes):
-        text = self.encoding.decode(chunk)
+        self.prepare_chunk_chat(current_summary, first, notes)
+        return self.send(self.encoding.decode(chunk), 500)
+
+    def prepare_chunk_chat(self, current_summary, first, notes):
         self.reset_chat()
-        if notes != '':
-            self.add_message(f'Keep in mind this note:\n{notes}', 'user')
-            self.add_message('Ok, I\'ll keep that in mind', 'assistant')
+        for m in self.note_messages(notes):
+            self.messages.append(m)
+            self.message_tokens += m.tokens
         if first:
             first = False
         else:
@@ -179,37 +410,97 @@ class Researcher(Bot):
             self.add_message(current_summary, "assistant")
             self.add_message("Are you ready for the next page?", "user")
             self.add_message("Yes, please provide the next page of text", "assistant")
-        return self.send(text, 500)
 
+    async def read_chunk_async(self, chunk, notes) -> str:
+        text = self.encoding.decode(chunk)
+        conversation = await self.send_async(text, self.packer.response_tokens, self.note_messages(notes))
+        self.close_conversation(conversation)
+        return conversation.messages[-1].content
+
+def is_more_comments(comment) -> bool:
+    # praw is only imported where the client is built, a type name check avoids importing it here
+    return type(comment).__name__ == 'MoreComments'
 
 class Editor(Bot):
-    def __init__(self, post_reader: PostReader):
+    def __init__(self, post_reader: PostReader, data_dir: str = '..'):
         super().__init__(post_reader, 'read_post')
+        self.duplicates = DuplicateIndex(f'{data_dir}/duplicates.db')
+
+    def harvest_comments(self, post: RedditPost, max_length: int) -> list:
+        # Every MoreComments expansion is another Reddit request, only expand as many as
+        # it could take to fill the prompt, assuming a page of comments fills ~2000 characters
+        more_limit = max(1, max_length // 2000)
+        # The comment tree is one request, PRAW paces the expansions itself
+        reddit_limiter.acquire()
+        with telemetry.span('comment_expansion', url=post.url) as span:
+            more = len([c for c in post.object.comments.list() if is_more_comments(c)])
+            skipped = post.object.comments.replace_more(limit=more_limit)
+            # Anything skipped means the whole limit was used, otherwise at least every
+            # placeholder seen up front was expanded. Counting them keeps later callers behind them
+            expansions = more_limit if len(skipped) > 0 else min(more_limit, more)
+            reddit_limiter.record(expansions)
+            # Comments are at least a few characters with the author name, so the prompt
+            # can never use more than this many of them
+            top_k = max_length // 40
+            # Skipped placeholders are still in the tree and have no score
+            comments = [c for c in post.object.comments.list() if not is_more_comments(c)]
+            span.set(comments=len(comments), expansions=expansions)
+            return heapq.nlargest(top_k, comments, key=lambda comment: comment.score)
 
-    def fetch_posts(self, subreddit: str, limit=10) -> List[Prompt]:
+    def fetch_posts(self, subreddit: str, limit=10, workers: int = 8) -> List[Prompt]:
         print(f'Getting posts from r/{subreddit}')
+        posts = self.duplicates.collapse(self.post_reader.get_posts(subreddit, limit))
+        return self.build_prompts(posts, workers)
+
+    def build_prompts(self, posts: List[RedditPost], workers: int = 8) -> List[Prompt]:
         ret_posts = []
-        posts = self.post_reader.get_posts(subreddit, limit)
+        if len(posts) == 0:
+            return ret_posts
+        # Comments are harvested by characters, a token is roughly four of them
+        max_length = self.prompt_budget() * 4
+        with ThreadPoolExecutor(workers) as executor:
+            post_top_comments = list(executor.map(lambda post: self.harvest_comments(post, max_length), posts))
 
-        max_length = 4000
-        for post in posts:
-            post.object.comments.replace_more(limit=None)
-            body_length = len(post.body[:max_length//2])
-            comments_text = ''
-            characters_left = max_length
-            post_comments = post.object.comments.list()
-            if (len(post_comments) > 0):
-                top_comments = sorted(post_comments, key=lambda comment: comment.score, reverse=True)
-                selected_comments = top_comments[:5]
-                comment_length = (max_length - body_length) // len(selected_comments)
-                comments_text = '\n'.join([f"{comment.author}: {comment.body[:comment_length]}" for comment in selected_comments])
-                comment_index = 5
-                while body_length + len(comments_text) < max_length and comment_index < len(top_comments):
-                    comment = top_comments[comment_index]
-                    comments_text += f'\n{comment.author}: {comment.body[:comment_length]}'
-                    comment_index += 1
-
-            characters_left -= len(comments_text)
-            post_reader_prompt = post.body[:characters_left] + '\nEND_POST\nBEGIN_COMMENTS:\n' + comments_text
-            ret_posts.append(Prompt(post.title, post_reader_prompt, post.url))
-        return ret_posts
\ No newline at end of file
+        for post, top_comments in zip(posts, post_top_comments):
+            ret_posts.append(self.build_prompt(post, top_comments))
+        return ret_posts
+
+    def prompt_budget(self, response_tokens: int = 100, margin: int = 150) -> int:
+        # Tokens left for the post and its comments once the system prompt, separator
+        # and response are accounted for. send refuses anything within 200 tokens of the
+        # context window, the margin keeps a full prompt clear of that
+        separator_tokens = len(self.encoding.encode(post_separator))
+        return self.context_window - self.system_prompt_tokens - separator_tokens - response_tokens - margin
+
+    def build_prompt(self, post: RedditPost, top_comments: list, response_tokens: int = 100, margin: int = 150) -> Prompt:
+        budget = self.prompt_budget(response_tokens, margin)
+        # Every token is at least one character, so slicing to a generous number of characters
+        # first keeps a huge post from being tokenized in full
+        body_tokens = self.encoding.encode(post.body[:budget * 8])
+        comments_budget = budget - min(len(body_tokens), budget // 2)
+
+        comment_lines = []
+        comment_tokens = 0
+        if len(top_comments) > 0:
+            comment_limit = comments_budget // min(5, len(top_comments))
+            for comment in top_comments:
+                line = f"{comment.author}: {comment.body[:comment_limit * 8]}"
+                line_tokens = self.encoding.encode(line)[:comment_limit]
+                # Each line also costs a newline, the line that does not fit is cut to what is left
+                if comment_tokens + len(line_tokens) + 1 > comments_budget:
+                    remaining = comments_budget - comment_tokens - 1
+                    if remaining > 0:
+                        comment_lines.append(self.encoding.decode(line_tokens[:remaining]))
+                        comment_tokens += remaining + 1
+                    break
+                comment_lines.append(self.encoding.decode(line_tokens))
+                comment_tokens += len(line_tokens) + 1
+
+        # The body gets whatever the comments did not use
+        body_tokens = body_tokens[:budget - comment_tokens]
+        text = ''.join([self.encoding.decode(body_tokens), post_separator, '\n'.join(comment_lines)])
+        # Decoding and joining the pieces can tokenize a little differently than the pieces did,
+        # the response gets whatever the finished prompt really leaves, up to response_tokens
+        prompt_tokens = self.system_prompt_tokens + len(self.encoding.encode(text))
+        response_tokens = max(1, min(response_tokens, self.context_window - prompt_tokens - margin))
+        return Prompt(post.title, text, post.url, response_tokens)
\ No newline at end of file
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Stores model responses on disk keyed on everything that affects the result
+class ResponseCache:
+    def __init__(self, directory: str, max_bytes: int = 100 * 1024 * 1024, ttl: int | None = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.tokens_saved = 0
+        # Running size of the directory, found with one scan on the first put and kept up to date after
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def key(self, config: dict) -> str:
+        request = {
+            "model": config.get("model"),
+            "temperature": config.get("temperature"),
+            "max_tokens": config.get("max_tokens"),
+            "messages": config.get("messages")
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, config: dict) -> dict | None:
+        if not self.enabled:
+            return None
+        path = self.path(self.key(config))
+        with self.lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                if self.ttl is not None and time.time() - entry['created'] > self.ttl:
+                    os.remove(path)
+                    self.misses += 1
+                    return None
+                # Touching the file keeps its mtime as the last access time for LRU eviction
+                os.utime(path)
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                # Missing, or evicted by another process since
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += size
+            self.tokens_saved += entry['total_tokens']
+            return entry
+
+    def put(self, config: dict, content: str, completion_tokens: int, total_tokens: int):
+        if not self.enabled:
+            return
+        entry = {
+            "content": content,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "created": time.time()
+        }
+        path = self.path(self.key(config))
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.total_bytes == None:
+                self.total_bytes = sum([size for _, size, _ in self.entries()])
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            # Written to a temporary file first so another process never reads half an entry
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+            self.total_bytes += os.path.getsize(path) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self) -> list:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return entries
+
+    def evict(self):
+        # Only runs once the cache is over its limit, and frees a tenth of it so the next
+        # few puts do not have to scan the directory again
+        entries = sorted(self.entries())
+        self.total_bytes = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "tokens_saved": self.tokens_saved
+        }
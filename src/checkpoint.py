@@ -0,0 +1,29 @@
+import json
+import os
+
+# Progress through a paper saved after every chunk so an interrupted read can pick up where it stopped
+class CheckpointStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, id: str) -> str:
+        return os.path.join(self.directory, id.replace('/', '_') + '.checkpoint.json')
+
+    def load(self, id: str) -> dict | None:
+        path = self.path(id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, id: str, state: dict):
+        # Written to a temporary file first so a crash mid write never leaves a broken checkpoint
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(id)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def clear(self, id: str):
+        if os.path.exists(self.path(id)):
+            os.remove(self.path(id))
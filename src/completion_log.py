@@ -0,0 +1,58 @@
+from typing import Iterator
+import gzip
+import json
+import os
+import threading
+import time
+
+from objects import Conversation
+
+# Append only JSONL log every finished conversation is written to shortly after it is closed.
+# Conversations are written in batches, every flush_every of them or every flush_interval seconds,
+# so a process that dies loses at most one batch. A path ending in .gz is gzip compressed
+class CompletionLog:
+    def __init__(self, path: str, flush_every: int = 20, flush_interval: float = 5):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, conversation: Conversation, bot: str = ''):
+        line = json.dumps({
+            "time": time.time(),
+            "bot": bot,
+            "messages": conversation.to_object()
+        }) + '\n'
+        with self.lock:
+            self.pending.append(line)
+            if len(self.pending) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.write_pending()
+
+    def write_pending(self):
+        self.last_flush = time.monotonic()
+        if len(self.pending) == 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Every batch is its own gzip member, closed before the next one starts, so the file
+        # only ever ends in an unfinished member if the process dies inside this call
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'at', encoding='utf-8') as f:
+            f.write(''.join(self.pending))
+        self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self.write_pending()
+
+    def close(self):
+        self.flush()
+
+def read_log(path: str) -> Iterator[dict]:
+    # Reads one conversation at a time so a large log never has to fit in memory
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() != '':
+                yield json.loads(line)
@@ -0,0 +1,170 @@
+from typing import Iterable, List
+from urllib.parse import urlparse, parse_qsl, urlencode
+import hashlib
+import re
+import time
+
+from objects import RedditPost
+from util import connect_db
+from telemetry import telemetry
+
+# Signatures are 64 bits split into four 16 bit bands. Two signatures within three bits of
+# each other must agree on at least one band, so a lookup only has to compare rows that share one
+bands = 4
+band_bits = 16
+
+def feature_hash(feature: str) -> int:
+    # Python's hash() changes every run, the signatures have to stay comparable across runs
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def simhash(features: Iterable[str]) -> int:
+    # Tallies how often each byte value shows up at each of the eight positions, then turns the
+    # tallies into per bit counts. Eight additions per feature instead of sixty four bit tests
+    tallies = [[0] * 256 for _ in range(8)]
+    total = 0
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+        for position in range(8):
+            tallies[position][digest[position]] += 1
+        total += 1
+    signature = 0
+    for position in range(8):
+        counts = [0] * 8
+        for value, tally in enumerate(tallies[position]):
+            if tally == 0:
+                continue
+            for bit in range(8):
+                if value >> bit & 1:
+                    counts[bit] += tally
+        for bit in range(8):
+            # A bit is set when more than half the features have it set
+            if counts[bit] * 2 > total:
+                signature |= 1 << (position * 8 + bit)
+    return signature
+
+def text_features(text: str, size: int = 3) -> List[str]:
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return [' '.join(words)] if len(words) > 0 else []
+    return [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+def token_features(tokens: List[int], size: int = 4) -> List[str]:
+    # Extracted paper text is already tokenized, shingling the token ids skips decoding it again
+    return [','.join(map(str, tokens[i:i + size])) for i in range(0, max(1, len(tokens) - size + 1))]
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+# Query parameters that only say where a link was shared from, never which page it is
+tracking_params = ['fbclid', 'gclid', 'ref', 'ref_src', 'ref_url', 'si', 'feature', 'share']
+
+def normalize_url(url: str) -> str:
+    # Only the host is case insensitive, paths and queries like youtube ids are not
+    parsed = urlparse(url.strip())
+    host = re.sub(r'^(www|old|m)\.', '', parsed.netloc.lower())
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not k.lower().startswith('utm_') and k.lower() not in tracking_params]
+    normalized = host + parsed.path.rstrip('/')
+    if len(query) > 0:
+        normalized += '?' + urlencode(sorted(query))
+    return normalized
+
+def to_signed(signature: int) -> int:
+    # sqlite integers are signed 64 bit
+    return signature - (1 << 64) if signature >= 1 << 63 else signature
+
+# Signatures of everything already summarized, so reposts, crossposts and the same story
+# shared in several threads are only paid for once, today or on a later run
+class DuplicateIndex:
+    def __init__(self, path: str, max_distance: int = 3, max_age_days: float = 30):
+        self.path = path
+        # The band lookup only finds every match up to three bits apart
+        self.max_distance = min(max_distance, bands - 1)
+        with connect_db(self.path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS signatures (
+                    kind TEXT,
+                    key TEXT,
+                    signature INTEGER,
+                    band0 INTEGER,
+                    band1 INTEGER,
+                    band2 INTEGER,
+                    band3 INTEGER,
+                    title TEXT,
+                    url TEXT,
+                    seen_at REAL,
+                    PRIMARY KEY (kind, key)
+                )
+            ''')
+            for band in range(bands):
+                db.execute(f'CREATE INDEX IF NOT EXISTS signatures_band{band} ON signatures (kind, band{band})')
+            db.execute('DELETE FROM signatures WHERE seen_at < ?', (time.time() - max_age_days * 86400,))
+
+    def band_values(self, signature: int) -> List[int]:
+        return [signature >> (band * band_bits) & ((1 << band_bits) - 1) for band in range(bands)]
+
+    def find(self, kind: str, key: str, signature: int, max_distance: int | None = None) -> dict | None:
+        max_distance = self.max_distance if max_distance == None else max_distance
+        where = ' OR '.join([f'band{band} = ?' for band in range(bands)])
+        with connect_db(self.path) as db:
+            rows = db.execute(
+                f'SELECT * FROM signatures WHERE kind = ? AND key != ? AND ({where})',
+                (kind, key, *self.band_values(signature))
+            ).fetchall()
+        best = None
+        for row in rows:
+            d = distance(signature, row['signature'] & ((1 << 64) - 1))
+            if d <= max_distance and (best == None or d < best[0]):
+                best = (d, dict(row))
+        return best[1] if best != None else None
+
+    def add(self, kind: str, key: str, signature: int, title: str, url: str):
+        with connect_db(self.path) as db:
+            db.execute('''
+                INSERT OR REPLACE INTO signatures
+                    (kind, key, signature, band0, band1, band2, band3, title, url, seen_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (kind, key, to_signed(signature), *self.band_values(signature), title, url, time.time()))
+
+    def post_signatures(self, post: RedditPost) -> List[tuple]:
+        # A link post is the same story wherever it is shared, the text catches reposts and crossposts
+        signatures = []
+        if not getattr(post.object, 'is_self', True) and 'reddit.com' not in post.object.url:
+            signatures.append(('url', feature_hash(normalize_url(post.object.url)), 0))
+        features = text_features(post.title + '\n' + post.body)
+        if len(features) > 0:
+            signatures.append(('post', simhash(features), self.max_distance))
+        return signatures
+
+    def collapse(self, posts: List[RedditPost]) -> List[RedditPost]:
+        # Posts come in best first, so the one kept from each group is the highest scored
+        kept = []
+        groups = {}
+        with telemetry.span('dedup', posts=len(posts)) as span:
+            for post in posts:
+                key = f't3_{post.object.id}'
+                signatures = self.post_signatures(post)
+                match = None
+                for kind, signature, max_distance in signatures:
+                    match = self.find(kind, key, signature, max_distance)
+                    if match != None:
+                        break
+                if match != None:
+                    groups.setdefault((match['title'], match['url']), []).append(post)
+                    continue
+                for kind, signature, max_distance in signatures:
+                    self.add(kind, key, signature, post.title, post.url)
+                kept.append(post)
+            span.set(duplicates=len(posts) - len(kept))
+        self.report(groups)
+        return kept
+
+    def report(self, groups: dict):
+        if len(groups) == 0:
+            return
+        print(f'Collapsed {sum([len(group) for group in groups.values()])} near duplicates:')
+        for (title, url), duplicates in groups.items():
+            print(f'  {title} ({url})')
+            for post in duplicates:
+                print(f'    duplicate: {post.title} ({post.url})')
@@ -1,32 +1,123 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+
 from gpt import GptCompletion, GptChat
+from objects import Conversation
 from util import save_file, open_file
 
 class Secretary(GptCompletion):
+    response_tokens = 300
+
     def __init__(self):
-        super().__init__(open_file('prompts/secretary.prompt'))
-    
-    def summarize(self, messages):
-        response_tokens = 300
+        super().__init__(open_file('../prompts/secretary.prompt'))
+
+    def transcript(self, messages) -> str:
         list = ''
         for m in messages:
-            list += f'\n\n{m["role"]}:\n{m["content"]}'
-        return self.complete(list, response_tokens)
+            list += f'\n\n{m.role}:\n{m.content}'
+        return list
+
+    def compact(self, messages) -> str:
+        return self.complete(self.transcript(messages), self.response_tokens)
+    
+    def summarize(self, messages, notes_file = 'director_notes.txt'):
+        # The notes are written as they are generated, the old ones are put back if that fails
+        previous = open_file(notes_file) if os.path.exists(notes_file) else None
+        try:
+            with open(notes_file, 'w', encoding='utf-8') as f:
+                def write(delta):
+                    f.write(delta)
+                    f.flush()
+                notes = self.complete(self.transcript(messages), self.response_tokens, on_delta=write)
+        except:
+            if previous != None:
+                save_file(notes_file, previous)
+            raise
+        save_file(notes_file, notes)
+        return notes
 
 class Director(GptChat):
-    def __init__(self):
+    stream = True
+    speaker = 'Director'
+    compaction: Future | None
+
+    def __init__(self, compact_at: int = 3000, keep_tokens: int = 1000):
         super().__init__('news_director')
         self.secretary = Secretary()
+        # Once the history passes compact_at tokens, everything but the last keep_tokens of it
+        # is summarized by the secretary in the background and swapped for the summary
+        self.compact_at = compact_at
+        self.keep_tokens = keep_tokens
+        self.executor = ThreadPoolExecutor(1)
+        self.compaction = None
+        self.compacted_until = 0
+
+    def compaction_cut(self) -> int:
+        # Index of the first message kept, always a user turn so each question stays with its answer
+        cut = len(self.messages)
+        kept_tokens = 0
+        for i in range(len(self.messages) - 1, 0, -1):
+            kept_tokens += self.messages[i].tokens
+            if kept_tokens > self.keep_tokens:
+                break
+            if self.messages[i].role == 'user':
+                cut = i
+        return cut
+
+    def start_compaction(self):
+        cut = self.compaction_cut()
+        if cut <= 2:
+            return
+        # The summarized turns are only ever appended after, so the slice stays valid until it is swapped
+        self.compacted_until = cut
+        self.compaction = self.executor.submit(self.secretary.compact, self.messages[1:cut])
+
+    def apply_compaction(self, wait: bool = False):
+        if self.compaction == None or (not wait and not self.compaction.done()):
+            return
+        compaction = self.compaction
+        self.compaction = None
+        try:
+            notes = compaction.result()
+        except Exception as e:
+            print(f'Could not compact the conversation: {e}')
+            return
+        cut = self.compacted_until
+        # The full turns still go to the completion log before they are dropped
+        self.close_conversation(Conversation(self.messages[:cut]))
+        self.messages = [
+            self.messages[0],
+            self.new_message('Here are your notes about the conversation so far:\n' + notes, 'user'),
+            self.new_message('Ok, I\'ll keep that in mind', 'assistant')
+        ] + self.messages[cut:]
+        self.message_tokens = sum([m.tokens for m in self.messages])
+        print(f'Compacted {cut - 1} messages into notes, history is now {self.message_tokens} tokens')
+
+    def make_room(self, message: str, max_tokens: int = 100):
+        # Only blocks when the next message would not fit before the background summary is done
+        needed = self.get_message_tokens() + len(self.encoding.encode(message)) + max_tokens
+        if needed < self.context_window - 200:
+            return
+        if self.compaction == None:
+            self.start_compaction()
+        self.apply_compaction(wait=True)
+
+    def chat(self, message: str):
+        self.apply_compaction()
+        self.make_room(message)
+        self.send(message)
+        if self.compaction == None and self.get_message_tokens() > self.compact_at:
+            self.start_compaction()
     
     def loop(self):
-        res = self.send('Here is the your notes about the companies current state of affairs:\n' + open_file('director_notes.txt'))
-        print(f'\nDirector:\n{res}')
+        self.chat('Here is the your notes about the companies current state of affairs:\n' + open_file('director_notes.txt'))
         while True:
             user_input = input('\n\nUser:\n')
-            if user_input == 'SAVE' or self.get_message_tokens() > 4000:
+            if user_input == 'SAVE':
+                self.apply_compaction(wait=True)
                 print('Summarizing')
-                notes = self.secretary.summarize(self.messages)
-                save_file('director_notes.txt', notes)
+                self.secretary.summarize(self.messages)
                 print('Notes saved')
+                self.executor.shutdown()
                 break
-            res = self.send(user_input)
-            print(f'\n\nDirector:\n{res}')
\ No newline at end of file
+            self.chat(user_input)
\ No newline at end of file
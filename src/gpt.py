@@ -1,28 +1,44 @@
 import datetime
-import json
-import time
 
-import tiktoken
-import openai
-from typing import List
-from util import open_file, save_file
+from typing import Deque, List, Tuple
+from collections import deque
+from util import open_file
 from objects import Conversation, Message
+from cache import ResponseCache
+from completion_log import CompletionLog
+from model_client import client
 
+cache = ResponseCache('../cache')
+# When set every bot streams its finished conversations here
+completion_log: CompletionLog | None = None
+encoding = None
+
+# One encoder shared by every bot, building it is not free so it waits until a bot needs it
+def get_encoding():
+    global encoding
+    if encoding == None:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return encoding
 
 class GptCompletion:
+    model = 'gpt-3.5-turbo'
+    context_window = 4096
+
     def __init__(self, system_prompt: str) -> None:
         self.system_prompt = system_prompt
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        self.encoding = get_encoding()
         self.system_prompt_tokens = len(self.encoding.encode(self.system_prompt))
         self.total_tokens = 0
 
-    def complete(self, prompt: str, response_tokens: int = 100, config: dict = {}):
+    # on_delta gets the reply piece by piece while it is streamed back
+    def complete(self, prompt: str, response_tokens: int = 100, config: dict = {}, fresh: bool = False, on_delta = None):
         prompt_tokens = len(self.encoding.encode(prompt))
         total_tokens = self.system_prompt_tokens + prompt_tokens + response_tokens
-        if total_tokens >= 4096:
-            raise "Chat completion error: too many tokens requested: " + total_tokens
+        if total_tokens >= self.context_window:
+            raise Exception(f"Chat completion error: too many tokens requested: {total_tokens}")
         defaultConfig = {
-            "model": 'gpt-3.5-turbo',
+            "model": self.model,
             "max_tokens": response_tokens,
             "messages": [
                 {
@@ -38,74 +54,164 @@ class GptCompletion:
         }
 
         defaultConfig.update(config)
-        res = openai.ChatCompletion.create(**defaultConfig)
-        msg = res.choices[0].message.content.strip()
-        self.total_tokens += res.usage.total_tokens
+        cached = None if fresh else cache.get(defaultConfig)
+        if cached != None:
+            if on_delta != None:
+                on_delta(cached['content'])
+            return cached['content']
+        if on_delta != None:
+            msg, completion_tokens = client.stream(defaultConfig, total_tokens - response_tokens, on_delta, self.encoding)
+            msg = msg.strip()
+            usage_tokens = total_tokens - response_tokens + completion_tokens
+        else:
+            res = client.create(defaultConfig, total_tokens - response_tokens)
+            msg = res.choices[0].message.content.strip()
+            completion_tokens = res.usage.completion_tokens
+            usage_tokens = res.usage.total_tokens
+        self.total_tokens += usage_tokens
+        cache.put(defaultConfig, msg, completion_tokens, usage_tokens)
         return msg
 
 class GptChat:
     messages: List[Message]
-    conversations: List[Conversation]
+    conversations: Deque[Conversation]
+    model = 'gpt-3.5-turbo'
+    context_window = 4096
+    # Prints replies as they are generated instead of waiting for the whole thing,
+    # under speaker or the prompt file name
+    stream = False
+    speaker: str | None = None
 
-    def __init__(self, system_prompt_file: str) -> None:
+    def __init__(self, system_prompt_file: str, max_conversations: int = 100) -> None:
+        self.name = system_prompt_file
         self.system_prompt = open_file('../prompts/' + system_prompt_file + '.prompt')
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        self.encoding = get_encoding()
         self.system_prompt_tokens = len(self.encoding.encode(self.system_prompt))
         self.messages = []
-        self.conversations = []
+        self.message_tokens = 0
+        # Only the most recent conversations stay in memory, the log has all of them
+        self.conversations = deque(maxlen=max_conversations)
         self.reset_chat()
         self.total_tokens = 0
 
     def save_completions(self, file_name):
+        if completion_log != None:
+            completion_log.flush()
+            return
+        # Without a log only the conversations still in memory can be saved, they are
+        # appended so a second run on the same day keeps the first
         if len(self.conversations) == 0:
             return
-        text = ''
-        for completion in self.conversations:
-            text += json.dumps(completion.to_object()) + '\n'
         today = datetime.date.today().strftime("%Y-%m-%d")
-        save_file(f'../completions/{file_name}_{today}.json', text)
+        log = CompletionLog(f'../completions/{file_name}_{today}.jsonl')
+        for conversation in self.conversations:
+            log.write(conversation, self.name)
+        log.close()
+        self.conversations.clear()
+
+    def close_conversation(self, conversation: Conversation):
+        self.conversations.append(conversation)
+        if completion_log != None:
+            completion_log.write(conversation, self.name)
+
+    def new_message(self, message: str, role: str) -> Message:
+        if role == "system" and message is self.system_prompt:
+            return Message(role, message, self.system_prompt_tokens)
+        return Message(role, message, len(self.encoding.encode(message)))
 
     def add_message(self, message: str, role: str):
-        self.messages.append(Message(role, message))
+        m = self.new_message(message, role)
+        self.messages.append(m)
+        self.message_tokens += m.tokens
+
+    def pop_message(self) -> Message:
+        m = self.messages.pop()
+        self.message_tokens -= m.tokens
+        return m
 
     def reset_chat(self):
         if len(self.messages) > 1:
-            self.conversations.append(Conversation(self.messages))
+            self.close_conversation(Conversation(self.messages))
         self.messages = [ ]
+        self.message_tokens = 0
         self.add_message(self.system_prompt, "system")
 
     def get_message_tokens(self) -> int:
-        message_tokens = 0
-        for m in self.messages:
-            message_tokens += len(self.encoding.encode(m.content))
-        return message_tokens
+        return self.message_tokens
 
-    def send(self, message: str, max_tokens=100) -> str:
+    def chat_config(self, messages: List[Message], max_tokens: int) -> dict:
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": Conversation(messages).to_object(),
+            "temperature": 0.5
+        }
+
+    def speaker_label(self) -> str:
+        return self.speaker if self.speaker != None else self.name
+
+    def request(self, config: dict, prompt_tokens: int) -> Tuple[str, int, int]:
+        # The reply with its completion and total token counts
+        if self.stream:
+            print(f'\n{self.speaker_label()}:')
+            msg, completion_tokens = client.stream(config, prompt_tokens, lambda delta: print(delta, end='', flush=True), self.encoding)
+            print()
+            return msg.strip(), completion_tokens, prompt_tokens + completion_tokens
+        res = client.create(config, prompt_tokens)
+        return res.choices[0].message.content.strip(), res.usage.completion_tokens, res.usage.total_tokens
+
+    def send(self, message: str, max_tokens=100, fresh: bool = False) -> str:
+        self.add_message(message, "user")
         message_tokens = self.get_message_tokens()
-        message_tokens += len(self.encoding.encode(message))
         print(f"Sending chat with {message_tokens} tokens")
         
-        if message_tokens >= 4096 - 200:
-            raise "Chat Error too many tokens"
+        if message_tokens >= self.context_window - 200:
+            self.pop_message()
+            raise Exception("Chat Error too many tokens")
         
-        self.add_message(message, "user")
-        
-        defaultConfig = {
-            "model": 'gpt-3.5-turbo',
-            "max_tokens": max_tokens,
-            "messages": Conversation(self.messages).to_object(),
-            "temperature": 0.5
-        }
+        defaultConfig = self.chat_config(self.messages, max_tokens)
+        cached = None if fresh else cache.get(defaultConfig)
+        if cached != None:
+            print(f"Using cached response with {cached['completion_tokens']} tokens")
+            if self.stream:
+                print(f"\n{self.speaker_label()}:\n{cached['content']}")
+            self.add_message(cached['content'], "assistant")
+            return cached['content']
 
         try:
-            res = openai.ChatCompletion.create(**defaultConfig)
+            msg, completion_tokens, total_tokens = self.request(defaultConfig, message_tokens)
         except:
-            print('Error when sending chat, retrying in one minute')
-            time.sleep(60)
-            self.messages = self.messages[:-1]
-            self.send(message, max_tokens)
+            # The message never got an answer, leave the history as it was before the call
+            self.pop_message()
+            raise
+        print(f"GPT API responded with {completion_tokens} tokens")
+        self.add_message(msg, "assistant")
+        self.total_tokens += total_tokens
+        cache.put(defaultConfig, msg, completion_tokens, total_tokens)
+        return msg
+
+    async def send_async(self, message: str, max_tokens=100, history: List[Message] = [], fresh: bool = False) -> Conversation:
+        # Sends on its own copy of the history so many of these can be in flight at once,
+        # self.messages is left untouched
+        messages = [self.new_message(self.system_prompt, "system")] + history
+        messages.append(self.new_message(message, "user"))
+        message_tokens = sum([m.tokens for m in messages])
+        print(f"Sending chat with {message_tokens} tokens")
+
+        if message_tokens >= self.context_window - 200:
+            raise Exception("Chat Error too many tokens")
+
+        config = self.chat_config(messages, max_tokens)
+        cached = None if fresh else cache.get(config)
+        if cached != None:
+            print(f"Using cached response with {cached['completion_tokens']} tokens")
+            messages.append(self.new_message(cached['content'], "assistant"))
+            return Conversation(messages)
+
+        res = await client.create_async(config, message_tokens)
         msg = res.choices[0].message.content.strip()
         print(f"GPT API responded with {res.usage.completion_tokens} tokens")
-        self.add_message(msg, "assistant")
+        messages.append(self.new_message(msg, "assistant"))
         self.total_tokens += res.usage.total_tokens
-        return msg
\ No newline at end of file
+        cache.put(config, msg, res.usage.completion_tokens, res.usage.total_tokens)
+        return Conversation(messages)
@@ -1,7 +1,11 @@
+import atexit
 import sys
 import json
-from praw import Reddit
+import datetime
 from reddit_reader import RedditNews
+import gpt
+from telemetry import telemetry
+from completion_log import CompletionLog
 
 def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
@@ -11,33 +15,93 @@ def save_file(filepath, content):
     with open(filepath, 'w', encoding='utf-8') as outfile:
         outfile.write(content)
 
+# --fresh skips the response cache so every completion is requested again
+if '--fresh' in sys.argv:
+    sys.argv.remove('--fresh')
+    gpt.cache.enabled = False
+
+# --dry-run prints the article instead of posting it to medium
+dry_run = '--dry-run' in sys.argv
+if dry_run:
+    sys.argv.remove('--dry-run')
+
+# --separate makes fan_out post one article per subreddit instead of one for all of them
+combined = '--separate' not in sys.argv
+if not combined:
+    sys.argv.remove('--separate')
+
+# --stream prints paper summaries as they are written, chat always streams
+stream = '--stream' in sys.argv
+if stream:
+    sys.argv.remove('--stream')
+
 command = 'chat'
 subreddit = 'all'
 if len(sys.argv) > 1:
     command = sys.argv[1]
     subreddit = sys.argv[2]
 else:
-    raise "Not enough arguments must be in form python main.py [Command] [Subreddit]\nwhere command is chat, news, research_news, or read_paper"
+    raise Exception("Not enough arguments must be in form python main.py [Command] [Subreddit]\nwhere command is chat, news, poll_news, research_news, research_batch, fan_out, or read_paper")
+
+today = datetime.date.today().strftime("%Y-%m-%d")
+telemetry.open(f'../traces/{command}_{today}.jsonl')
+gpt.completion_log = CompletionLog(f'../completions/{command}_{subreddit}_{today}.jsonl.gz')
+# Whatever is still buffered is written even when a command fails part way
+atexit.register(gpt.completion_log.close)
 
 config = json.loads(open_file('../config.json'))
 
-reddit_client = Reddit(
-    client_id=config["reddit_id"],
-    client_secret=config["reddit_secret"],
-    user_agent=config["reddit_app"]
-)
+# chat never reads reddit, so praw is not even imported for it
+reddit_client = None
+if command != 'chat':
+    from praw import Reddit
+    reddit_client = Reddit(
+        client_id=config["reddit_id"],
+        client_secret=config["reddit_secret"],
+        user_agent=config["reddit_app"]
+    )
+
+# Papers can be read with a larger context model, set research_model and research_context_window in config.json
+research_model = None
+if config.get("research_model") != None:
+    if config.get("research_context_window") == None:
+        raise Exception("research_model in config.json also needs research_context_window")
+    research_model = (config["research_model"], int(config["research_context_window"]))
 
-reader = RedditNews(config["openai_key"], config["medium_key"], reddit_client)
+reader = RedditNews(config["openai_key"], config["medium_key"], reddit_client, dry_run, research_model=research_model)
+
+if stream and command in ['research_news', 'read_paper']:
+    reader.researcher.set_stream(True)
 
 post_url = ''
 if command == 'chat':
     reader.director_chat()
 elif command == 'news':
     post_url, post_id = reader.create_news_article(subreddit)
+elif command == 'poll_news':
+    post_url, post_id = reader.poll_news_article(subreddit)
 elif command == 'research_news':
     post_url, post_id = reader.find_papers(subreddit)
+elif command == 'research_batch':
+    post_url, post_id = reader.find_papers_batch(subreddit, sys.argv[3])
+elif command == 'fan_out':
+    # Subreddits are given as a comma separated list or as @file with one per line
+    if subreddit.startswith('@'):
+        subreddits = [s.strip() for s in open_file(subreddit[1:]).split('\n') if s.strip() != '']
+    else:
+        subreddits = [s.strip() for s in subreddit.split(',') if s.strip() != '']
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'news'
+    rules_file = sys.argv[4] if len(sys.argv) > 4 else None
+    ret_val = reader.fan_out(subreddits, mode, rules_file, combined)
+    post_url = ret_val[0] if combined else ', '.join([r[0] for r in ret_val])
 elif command == 'read_paper':
-    ret_val = reader.read_paper(subreddit)
+    strategy = sys.argv[3] if len(sys.argv) > 3 else 'serial'
+    ret_val = reader.read_paper(subreddit, strategy)
     if ret_val != None:
         post_url = ret_val[0]
-print('Post: ' + post_url)
\ No newline at end of file
+print('Post: ' + post_url)
+print(f'Cache: {gpt.cache.stats()}')
+
+telemetry.close()
+telemetry.save_snapshot('../traces/metrics.prom')
+print(telemetry.summary())
\ No newline at end of file
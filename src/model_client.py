@@ -0,0 +1,187 @@
+from typing import Tuple
+import asyncio
+import random
+import threading
+import time
+
+from telemetry import telemetry
+from rate_limit import RateLimiter, openai_limiter, openai_token_limiter
+
+api_key = None
+
+# Errors worth another attempt, everything else (bad request, auth) fails the same way every time
+retryable_errors = [
+    'RateLimitError',
+    'APIError',
+    'Timeout',
+    'TryAgain',
+    'APIConnectionError',
+    'ServiceUnavailableError'
+]
+
+# openai is slow to import, so it is only loaded for the first model call
+def get_openai():
+    import openai
+    if api_key != None:
+        openai.api_key = api_key
+    return openai
+
+def is_retryable(e: Exception) -> bool:
+    status = getattr(e, 'http_status', None)
+    if status != None:
+        return status == 429 or status >= 500
+    return type(e).__name__ in retryable_errors
+
+def is_rate_limit(e: Exception) -> bool:
+    return type(e).__name__ == 'RateLimitError' or getattr(e, 'http_status', None) == 429
+
+def retry_after(e: Exception) -> float | None:
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class CircuitOpenError(Exception):
+    pass
+
+# Stops calling the api at all after enough calls in a row gave up on it. Once the cooldown has
+# passed a single trial call goes through, its success closes the breaker and its failure opens it again
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 120):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at == None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(f"Model api unavailable after {self.failures} failures, retry in {max(remaining, 0):.0f}s")
+            # Half open, every other caller keeps failing fast until this one finishes
+            self.trial = True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                print(f"Model api failed {self.failures} times in a row, pausing calls for {self.cooldown}s")
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+# Every model call goes through here. Calls are paced ahead of time against the request and
+# token limits, failures are retried with jittered exponential backoff and a rate limit
+# error slows down every caller, not just the one that hit it
+class ModelClient:
+    def __init__(self, requests: RateLimiter, tokens: RateLimiter, max_retries: int = 6, base_delay: float = 1, max_delay: float = 60):
+        self.requests = requests
+        self.tokens = tokens
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker()
+
+    def reserve(self, config: dict, prompt_tokens: int) -> float:
+        return max(self.requests.reserve(), self.tokens.reserve(prompt_tokens + config.get('max_tokens', 0)))
+
+    def backoff(self, e: Exception, attempt: int) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_after(e)
+        if hint != None:
+            delay = max(delay, hint)
+        if is_rate_limit(e):
+            self.requests.pause(delay)
+        return delay
+
+    def failed(self, e: Exception, attempt: int, span) -> float:
+        # Returns how long to wait before the next attempt, or raises if there will not be one.
+        # The breaker only counts a call that gave up on an outage, once. Rate limits and bad
+        # requests mean the api is answering
+        if not is_retryable(e):
+            self.breaker.success()
+            raise e
+        if attempt >= self.max_retries:
+            if is_rate_limit(e):
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+            raise e
+        delay = self.backoff(e, attempt)
+        span.set(retries=1, error=type(e).__name__)
+        print(f"Model call failed with {type(e).__name__}, retrying in {delay:.1f}s")
+        return delay
+
+    def run(self, config: dict, prompt_tokens: int, request):
+        self.breaker.check()
+        for attempt in range(self.max_retries + 1):
+            wait = self.reserve(config, prompt_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            with telemetry.span('model_call', max_tokens=config.get('max_tokens', 0), attempt=attempt) as span:
+                try:
+                    res = request(span)
+                except Exception as e:
+                    delay = self.failed(e, attempt, span)
+                else:
+                    self.breaker.success()
+                    return res
+            time.sleep(delay)
+
+    def create(self, config: dict, prompt_tokens: int = 0):
+        def request(span):
+            res = get_openai().ChatCompletion.create(**config)
+            span.set(prompt_tokens=res.usage.prompt_tokens, completion_tokens=res.usage.completion_tokens)
+            return res
+        return self.run(config, prompt_tokens, request)
+
+    def stream(self, config: dict, prompt_tokens: int, on_delta, encoding) -> Tuple[str, int]:
+        # Hands every piece of the reply to on_delta as it arrives and returns the whole reply
+        # with its token count. A stream cut off part way is requested again from the start
+        def request(span):
+            parts = []
+            try:
+                for chunk in get_openai().ChatCompletion.create(stream=True, **config):
+                    delta = chunk['choices'][0]['delta'].get('content')
+                    if delta:
+                        parts.append(delta)
+                        on_delta(delta)
+            except Exception:
+                if len(parts) > 0:
+                    on_delta('\n[reply interrupted]\n')
+                raise
+            # Streamed replies carry no usage, the reply is counted with the encoder instead
+            msg = ''.join(parts)
+            completion_tokens = len(encoding.encode(msg))
+            span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, stream=True)
+            return msg, completion_tokens
+        return self.run(config, prompt_tokens, request)
+
+    async def create_async(self, config: dict, prompt_tokens: int = 0):
+        self.breaker.check()
+        for attempt in range(self.max_retries + 1):
+            wait = self.reserve(config, prompt_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            with telemetry.span('model_call', max_tokens=config.get('max_tokens', 0), attempt=attempt) as span:
+                try:
+                    res = await get_openai().ChatCompletion.acreate(**config)
+                except Exception as e:
+                    delay = self.failed(e, attempt, span)
+                else:
+                    self.breaker.success()
+                    span.set(prompt_tokens=res.usage.prompt_tokens, completion_tokens=res.usage.completion_tokens)
+                    return res
+            await asyncio.sleep(delay)
+
+client = ModelClient(openai_limiter, openai_token_limiter)
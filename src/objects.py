@@ -16,11 +16,13 @@ class Prompt:
     title: str
     text: str
     url: str
+    response_tokens: int
 
-    def __init__(self, title: str, text: str, url: str):
+    def __init__(self, title: str, text: str, url: str, response_tokens: int = 100):
         self.title = title
         self.text = text
         self.url = url
+        self.response_tokens = response_tokens
 
 class Summary(Prompt):
     def __init__(self, title: str, text: str, url: str):
@@ -29,10 +31,12 @@ class Summary(Prompt):
 class Message:
     role: str
     content: str
+    tokens: int
 
-    def __init__(self, role: str, content: str):
+    def __init__(self, role: str, content: str, tokens: int = 0):
         self.role = role
         self.content = content
+        self.tokens = tokens
 
 class Conversation:
     messages: List[Message]
@@ -0,0 +1,44 @@
+from typing import List, Tuple
+
+# Fills whatever context is left after the prompt history with as much of the text as fits,
+# cutting at a paragraph or sentence boundary and overlapping the next chunk a little
+class ContextPacker:
+    def __init__(self, encoding, context_window: int = 4096, response_tokens: int = 500, overlap: int = 50, margin: int = 50):
+        self.encoding = encoding
+        self.context_window = context_window
+        self.response_tokens = response_tokens
+        self.overlap = overlap
+        # Covers the per message overhead the api adds on top of the content tokens
+        self.margin = margin
+
+    def free_tokens(self, used_tokens: int) -> int:
+        return self.context_window - self.response_tokens - self.margin - used_tokens
+
+    def boundary(self, tokens: List[int], start: int, end: int) -> int:
+        # Looks back over the last fifth of the chunk for a paragraph break, then a sentence end
+        sentence_end = None
+        for i in range(end - 1, max(start, end - (end - start) // 5) - 1, -1):
+            text = self.encoding.decode([tokens[i]])
+            if '\n\n' in text:
+                return i + 1
+            if sentence_end == None and ('. ' in text or text.endswith('.') or '\n' in text):
+                sentence_end = i + 1
+        return sentence_end if sentence_end != None else end
+
+    def next_chunk(self, tokens: List[int], offset: int, used_tokens: int) -> Tuple[List[int], int]:
+        free = self.free_tokens(used_tokens)
+        if free <= self.overlap:
+            raise Exception(f"No room left in the context window, {used_tokens} tokens already used")
+        end = min(offset + free, len(tokens))
+        if end == len(tokens):
+            return tokens[offset:end], end
+        end = self.boundary(tokens, offset, end)
+        return tokens[offset:end], max(end - self.overlap, offset + 1)
+
+    def split(self, tokens: List[int], used_tokens: int) -> List[List[int]]:
+        chunks = []
+        offset = 0
+        while offset < len(tokens):
+            chunk, offset = self.next_chunk(tokens, offset, used_tokens)
+            chunks.append(chunk)
+        return chunks
@@ -0,0 +1,97 @@
+import os
+import re
+import time
+
+from util import open_file, connect_db
+
+# Strips urls, the .pdf extension and the version from an arxiv id so
+# 2302.07459v2, arxiv.org/abs/2302.07459 and arxiv.org/pdf/2302.07459.pdf are the same paper
+def normalize_id(id: str) -> str:
+    id = id.strip()
+    id = re.sub(r'[?#].*$', '', id)
+    id = re.sub(r'^.*arxiv\.org/(abs|pdf)/', '', id)
+    id = id.rstrip('/')
+    id = re.sub(r'\.pdf$', '', id)
+    id = re.sub(r'v\d+$', '', id)
+    return id
+
+# New style ids are yymm.number, old style ones are archive/yymmnumber like hep-th/9901001
+id_pattern = re.compile(r'^(\d{4}\.\d{4,5}|[a-z\-]+(\.[A-Z]{2})?/\d{7})$')
+
+# Anything else, a /list/ page for one, makes the export api answer the whole batch with an error
+def is_valid_id(id: str) -> bool:
+    return id_pattern.match(normalize_id(id)) != None
+
+# Every paper that has been read, keyed by normalized arxiv id
+class PaperRegistry:
+    def __init__(self, path: str, legacy_files: list = ['../arvix_papers.txt', '../arxiv_papers.txt']):
+        self.path = path
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS papers (
+                    id TEXT PRIMARY KEY,
+                    title TEXT,
+                    pdf_url TEXT,
+                    summary TEXT,
+                    tokens INTEGER DEFAULT 0,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            ''')
+            # Registries made before near duplicates were tracked lack the column
+            columns = [row['name'] for row in db.execute('PRAGMA table_info(papers)')]
+            if 'duplicate_of' not in columns:
+                db.execute('ALTER TABLE papers ADD COLUMN duplicate_of TEXT')
+        for file in legacy_files:
+            if os.path.exists(file):
+                self.import_ids(open_file(file).split('\n'))
+
+    def connect(self):
+        return connect_db(self.path)
+
+    def import_ids(self, ids: list):
+        now = time.time()
+        with self.connect() as db:
+            db.executemany(
+                'INSERT OR IGNORE INTO papers (id, created_at, updated_at) VALUES (?, ?, ?)',
+                [(normalize_id(id), now, now) for id in ids if id.strip() != '']
+            )
+
+    def has(self, id: str) -> bool:
+        with self.connect() as db:
+            row = db.execute('SELECT 1 FROM papers WHERE id = ?', (normalize_id(id),)).fetchone()
+        return row != None
+
+    def get(self, id: str) -> dict | None:
+        with self.connect() as db:
+            row = db.execute('SELECT * FROM papers WHERE id = ?', (normalize_id(id),)).fetchone()
+        if row == None:
+            return None
+        return dict(row)
+
+    def record(self, id: str, title: str, pdf_url: str, summary: str, tokens: int):
+        now = time.time()
+        with self.connect() as db:
+            db.execute('''
+                INSERT INTO papers (id, title, pdf_url, summary, tokens, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    title = excluded.title,
+                    pdf_url = excluded.pdf_url,
+                    summary = excluded.summary,
+                    tokens = papers.tokens + excluded.tokens,
+                    updated_at = excluded.updated_at
+            ''', (normalize_id(id), title, pdf_url, summary, tokens, now, now))
+
+    def record_duplicate(self, id: str, original_id: str, title: str, pdf_url: str):
+        # Marks the paper as seen so discovery skips it, it has no summary of its own
+        now = time.time()
+        with self.connect() as db:
+            db.execute('''
+                INSERT INTO papers (id, title, pdf_url, duplicate_of, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    duplicate_of = excluded.duplicate_of,
+                    updated_at = excluded.updated_at
+            ''', (normalize_id(id), title, pdf_url, normalize_id(original_id), now, now))
@@ -0,0 +1,140 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List
+import mmap
+import os
+
+from telemetry import telemetry
+
+# Each worker process opens the pdf once and keeps it here
+worker_reader = None
+
+def open_pdf(path: str):
+    import PyPDF2
+    global worker_reader
+    f = open(path, 'rb')
+    worker_reader = PyPDF2.PdfReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def extract_page(page_num: int) -> str:
+    return worker_reader.pages[page_num].extract_text()
+
+def download_pdf(url: str, path: str, chunk_size: int = 1024 * 64, session = None) -> bool:
+    if session == None:
+        import requests
+        session = requests
+    # Spool straight to disk instead of holding the whole response in memory
+    response = session.get(url, stream=True)
+    if response.status_code != 200:
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.part', 'wb') as f:
+        for block in response.iter_content(chunk_size):
+            f.write(block)
+    os.replace(path + '.part', path)
+    return True
+
+def page_count(path: str) -> int:
+    import PyPDF2
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return len(PyPDF2.PdfReader(m).pages)
+
+def extract_pages(path: str, workers: int = 4) -> Iterator[str]:
+    # Yields page text in order, only keeping a few pages ahead of the consumer
+    # so stopping early does not extract the rest of the paper
+    num_pages = page_count(path)
+    print(f"Paper has {num_pages} pages")
+    with ProcessPoolExecutor(workers, initializer=open_pdf, initargs=(path,)) as executor:
+        pending = []
+        next_page = 0
+        try:
+            while next_page < num_pages or len(pending) > 0:
+                while next_page < num_pages and len(pending) < workers * 2:
+                    pending.append(executor.submit(extract_page, next_page))
+                    next_page += 1
+                yield pending.pop(0).result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+# Extracted text and token ids for papers that have already been read, by arxiv id
+class PaperTextStore:
+    def __init__(self, directory: str, session = None, workers: int = 4):
+        self.directory = directory
+        self.session = session
+        self.downloads = {}
+        self.executor = ThreadPoolExecutor(workers)
+
+    def path(self, id: str, extension: str) -> str:
+        return os.path.join(self.directory, id.replace('/', '_') + extension)
+
+    def pdf_path(self, id: str) -> str:
+        return self.path(id, '.pdf')
+
+    def load_tokens(self, id: str, max_tokens: int) -> List[int] | None:
+        path = self.path(id, '.tokens')
+        if not os.path.exists(path):
+            return None
+        tokens = array('I')
+        with open(path, 'rb') as f:
+            tokens.frombytes(f.read())
+        # A truncated extraction is only good enough if it covers this budget
+        if len(tokens) < max_tokens and not os.path.exists(self.path(id, '.done')):
+            return None
+        return tokens[:max_tokens].tolist()
+
+    def save(self, id: str, text: str, tokens: List[int], complete: bool):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(id, '.txt'), 'w', encoding='utf-8') as f:
+            f.write(text)
+        with open(self.path(id, '.tokens'), 'wb') as f:
+            array('I', tokens).tofile(f)
+        if complete:
+            open(self.path(id, '.done'), 'w').close()
+        elif os.path.exists(self.path(id, '.done')):
+            os.remove(self.path(id, '.done'))
+
+    def download(self, id: str, url: str) -> bool:
+        pdf_path = self.pdf_path(id)
+        if os.path.exists(pdf_path):
+            return True
+        with telemetry.span('pdf_download', id=id) as span:
+            downloaded = download_pdf(url, pdf_path, session=self.session)
+            span.set(downloaded=downloaded)
+        return downloaded
+
+    def prefetch(self, id: str, url: str):
+        # Starts downloading in the background, extract waits on it if it is still running
+        if id in self.downloads or os.path.exists(self.path(id, '.tokens')):
+            return
+        self.downloads[id] = self.executor.submit(self.download, id, url)
+
+    def extract(self, id: str, url: str, encoding, max_tokens: int) -> List[int] | None:
+        tokens = self.load_tokens(id, max_tokens)
+        if tokens != None:
+            print(f"Using stored text for paper {id}")
+            return tokens
+
+        print("Downloading pdf")
+        if id in self.downloads:
+            downloaded = self.downloads.pop(id).result()
+        else:
+            downloaded = self.download(id, url)
+        if not downloaded:
+            print("Could not find pdf for paper")
+            return None
+        pdf_path = self.pdf_path(id)
+
+        pages = []
+        tokens = []
+        complete = True
+        with telemetry.span('pdf_extract', id=id) as span:
+            for page in extract_pages(pdf_path):
+                pages.append(page)
+                tokens.extend(encoding.encode(' ' + page))
+                if len(tokens) >= max_tokens:
+                    complete = False
+                    break
+            span.set(pages=len(pages), tokens=len(tokens))
+        self.save(id, ' '.join(pages), tokens, complete)
+        return tokens[:max_tokens]
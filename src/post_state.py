@@ -0,0 +1,71 @@
+import time
+
+from objects import RedditPost
+from util import connect_db
+
+# The parts of a post that decide whether it needs summarizing again
+def fingerprint(post: RedditPost) -> dict:
+    edited = getattr(post.object, 'edited', False)
+    return {
+        "score": getattr(post.object, 'score', 0),
+        "num_comments": getattr(post.object, 'num_comments', 0),
+        "edited": float(edited) if edited else 0.0
+    }
+
+# Posts already summarized for each subreddit, so a poll only pays for what changed
+class PostState:
+    def __init__(self, path: str, score_change: float = 0.5, comment_change: float = 0.25):
+        self.path = path
+        self.score_change = score_change
+        self.comment_change = comment_change
+        with connect_db(self.path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS posts (
+                    subreddit TEXT,
+                    id TEXT,
+                    title TEXT,
+                    url TEXT,
+                    score INTEGER,
+                    num_comments INTEGER,
+                    edited REAL,
+                    summary TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (subreddit, id)
+                )
+            ''')
+
+    def get(self, subreddit: str, post: RedditPost) -> dict | None:
+        with connect_db(self.path) as db:
+            row = db.execute(
+                'SELECT * FROM posts WHERE subreddit = ? AND id = ?',
+                (subreddit.lower(), post.object.id)
+            ).fetchone()
+        if row == None:
+            return None
+        return dict(row)
+
+    def changed(self, stored: dict | None, post: RedditPost) -> bool:
+        if stored == None or stored['summary'] == None:
+            return True
+        current = fingerprint(post)
+        if current['edited'] != stored['edited']:
+            return True
+        # Small drifts in score and comment count happen all day, only a big jump is news
+        comment_growth = current['num_comments'] - stored['num_comments']
+        if comment_growth >= max(10, stored['num_comments'] * self.comment_change):
+            return True
+        score_change = abs(current['score'] - stored['score'])
+        return score_change >= max(100, stored['score'] * self.score_change)
+
+    def record(self, subreddit: str, post: RedditPost, summary: str):
+        current = fingerprint(post)
+        with connect_db(self.path) as db:
+            db.execute('''
+                INSERT OR REPLACE INTO posts
+                    (subreddit, id, title, url, score, num_comments, edited, summary, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                subreddit.lower(), post.object.id, post.title, post.url,
+                current['score'], current['num_comments'], current['edited'], summary, time.time()
+            ))
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+
+# Token bucket shared by every caller of a service. Callers reserve their slot up front
+# and sleep until it comes around, so concurrent callers queue up instead of racing
+class RateLimiter:
+    def __init__(self, per_minute: float, burst: float = 1):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, amount: float = 1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float = 1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record(self, amount: float = 1):
+        # Counts requests something else already made and paced, later callers wait for them
+        self.reserve(amount)
+
+    def pause(self, seconds: float):
+        # Pushes every caller back, used when the service says we are already over its limit
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.last = time.monotonic()
+
+# Reddit allows 100 requests a minute for an oauth client, averaged over a 10 minute window
+reddit_limiter = RateLimiter(100, burst=1000)
+openai_limiter = RateLimiter(3500, burst=20)
+# Prompt plus requested completion tokens, a call reserves both before it is sent
+openai_token_limiter = RateLimiter(90000, burst=20000)
@@ -1,18 +1,26 @@
-from praw import Reddit
-from typing import List
+from typing import List, TYPE_CHECKING
 from objects import RedditPost
+from telemetry import telemetry
+from rate_limit import reddit_limiter
 import json
 
+if TYPE_CHECKING:
+    from praw import Reddit
+
 # Gets a list of posts from a subreddit
 class PostReader:
-    def __init__(self, client: Reddit):
+    def __init__(self, client: 'Reddit'):
         self.client = client
 
     def get_posts(self, subreddit, limit) -> List[RedditPost]:
         ret_posts = []
         sub = self.client.subreddit(subreddit)
 
-        posts = list(sub.hot(limit=limit))
+        # Listings come back a hundred posts per request
+        reddit_limiter.acquire(max(1, (limit + 99) // 100))
+        with telemetry.span('reddit_fetch', subreddit=subreddit, limit=limit) as span:
+            posts = list(sub.hot(limit=limit))
+            span.set(posts=len(posts))
         posts.sort(key=lambda post: post.score, reverse=True)
         for post in posts:
             post_url = f"https://www.reddit.com{post.permalink}"
@@ -1,42 +1,85 @@
-import openai
-from typing import List
+from typing import List, Tuple
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import datetime
-from medium import Client
+import model_client
 from reddit import PostReader
 from bots import Editor, Researcher
+from batch import ReadRules, PaperQueue, ProgressLog
 from objects import Summary
+from post_state import PostState
+from telemetry import telemetry
 
 class RedditNews:
     def __init__(self, 
             api_key: str, 
             medium_token: str,
-            reddit_client
+            reddit_client,
+            dry_run: bool = False,
+            data_dir: str = '..',
+            research_model: Tuple[str, int] = None
         ):
-        openai.api_key = api_key
-        post_reader = PostReader(reddit_client)
-        self.editor = Editor(post_reader)
-        self.researcher = Researcher(post_reader)
-        self.medium = Client(access_token=medium_token)
-        user = self.medium.get_current_user()
-        self.medium_user_id = user['id']
+        model_client.api_key = api_key
+        self.post_reader = PostReader(reddit_client)
+        self.medium_token = medium_token
+        self.medium_user_id = None
+        self.dry_run = dry_run
+        # Where the paper store, registry and post state live
+        self.data_dir = data_dir
+        # Model and context window papers are read with, None keeps the bots' default
+        self.research_model = research_model
         self.completions = []
 
+    # Each subsystem is only built the first time a command uses it
+
+    @cached_property
+    def editor(self) -> Editor:
+        return Editor(self.post_reader, self.data_dir)
+
+    @cached_property
+    def researcher(self) -> Researcher:
+        return self.new_researcher()
+
+    def new_researcher(self, paper_text=None) -> Researcher:
+        researcher = Researcher(self.post_reader, self.data_dir, paper_text)
+        if self.research_model != None:
+            researcher.set_model(*self.research_model)
+        return researcher
+
+    @cached_property
+    def post_state(self) -> PostState:
+        return PostState(f'{self.data_dir}/posts.db')
+
+    @cached_property
+    def director(self):
+        from director import Director
+        return Director()
+
+    @cached_property
+    def medium(self):
+        return self.new_medium_client()
+
+    def new_medium_client(self):
+        from medium import Client
+        return Client(access_token=self.medium_token)
+
     def director_chat(self):
         self.director.loop()
 
-    def read_paper(self, id: str):
+    def read_paper(self, id: str, strategy: str = 'serial'):
         def to_snake_case(string):
             string = string.lower().replace(' ', '_').replace('-', '_')
             return ''.join(['_' + i.lower() if i.isupper() else i for i in string]).lstrip('_')
         
-        summary = self.researcher.read_paper(id)
+        summary = self.researcher.read_paper(id, strategy=strategy)
         if summary == None:
             print("Error occured, exiting")
             return None
         print("Saving completions to file")
         self.researcher.save_completions(f'arxiv_{to_snake_case(summary.title)}_paper')
         print("Posting article to medium")
-        print(f'Tokens: {self.researcher.total_tokens}')
+        print(f'Tokens: {self.researcher.total_tokens + self.researcher.summarizer.total_tokens}')
         return self.post_to_medium([summary], f'Arxiv paper: {summary.title}')
 
     def find_papers(self, subreddit: str, limit=100):
@@ -45,17 +88,119 @@ class RedditNews:
         print("Saving completions to file")
         self.researcher.save_completions(f'{subreddit}_papers')
         print("Posting article to medium")
-        print(f'Tokens: {self.researcher.total_tokens}')
+        print(f'Tokens: {self.researcher.total_tokens + self.researcher.summarizer.total_tokens}')
         return self.post_to_medium(summaries, f'Arxiv papers from r/{subreddit}')
 
-    def create_news_article(self, subreddit: str, limit: int=10):
+    def find_papers_batch(self, subreddit: str, rules_file: str, limit=100, workers=4, log: ProgressLog = None):
+        rules = ReadRules.from_file(rules_file)
+        papers = self.researcher.discover_papers(subreddit, limit)
+        accepted = [paper for paper in papers if rules.accepts(paper.title, paper.abstract)]
+        print(f"Accepted {len(accepted)} of {len(papers)} papers")
+
+        def new_researcher():
+            # Workers share the pdf store so they pick up the downloads already prefetched
+            return self.new_researcher(self.researcher.paper_text)
+
+        # Rejected papers still go through the queue so the progress log reports them
+        paper_queue = PaperQueue(new_researcher, workers, log)
+        summaries = paper_queue.run(papers, rules)
+        for researcher in paper_queue.researchers:
+            self.researcher.conversations += researcher.conversations + researcher.summarizer.conversations
+            self.researcher.total_tokens += researcher.total_tokens
+            self.researcher.summarizer.total_tokens += researcher.summarizer.total_tokens
+            for original, duplicates in researcher.collapsed_papers.items():
+                self.researcher.collapsed_papers.setdefault(original, []).extend(duplicates)
+        self.researcher.report_duplicates()
+        print("Saving completions to file")
+        self.researcher.save_completions(f'{subreddit}_papers')
+        print("Posting article to medium")
+        print(f'Tokens: {self.researcher.total_tokens + self.researcher.summarizer.total_tokens}')
+        return self.post_to_medium(summaries, f'Arxiv papers from r/{subreddit}')
+
+    def poll_news_article(self, subreddit: str, limit: int=10, concurrency: int=5):
+        # Only new posts and posts that changed a lot since the last poll are summarized,
+        # the rest reuse their stored summary
+        print(f'Getting posts from r/{subreddit}')
+        posts = self.editor.duplicates.collapse(self.post_reader.get_posts(subreddit, limit))
+        stored = [self.post_state.get(subreddit, post) for post in posts]
+        changed = [post for post, state in zip(posts, stored) if self.post_state.changed(state, post)]
+        print(f'{len(changed)} of {len(posts)} posts are new or changed')
+
+        prompts = self.editor.build_prompts(changed)
+        new_summaries = self.editor.complete_promts(prompts, concurrency)
+        summaries = {}
+        for post, summary in zip(changed, new_summaries):
+            self.post_state.record(subreddit, post, summary.text)
+            summaries[post.url] = summary
+        for post, state in zip(posts, stored):
+            if post.url not in summaries:
+                summaries[post.url] = Summary(post.title, state['summary'], post.url)
+
+        self.editor.save_completions(f'{subreddit}_news')
+        print(f'Tokens: {self.editor.total_tokens}')
+        return self.post_to_medium([summaries[post.url] for post in posts], f'Reddit News: r/{subreddit}')
+
+    def create_news_article(self, subreddit: str, limit: int=10, concurrency: int=5):
         prompts = self.editor.fetch_posts(subreddit, limit)
-        posts = self.editor.complete_promts(prompts)
+        posts = self.editor.complete_promts(prompts, concurrency)
 
         self.editor.save_completions(f'{subreddit}_news')
         print(f'Tokens: {self.editor.total_tokens}')
         return self.post_to_medium(posts, f'Reddit News: r/{subreddit}')
 
+    def fan_out(self, subreddits: List[str], mode: str = 'news', rules_file: str | None = None, combined: bool = True, limit: int = 10, workers: int = 4):
+        # Runs every subreddit at once, all of them share the reddit and openai limiters.
+        # A post or paper that shows up in several subreddits is only summarized once
+        if mode != 'news' and rules_file == None:
+            raise Exception('Reading papers for several subreddits at once needs a rules file')
+        rules = ReadRules.from_file(rules_file) if rules_file != None else None
+        claimed = set()
+        lock = threading.Lock()
+        tokens = []
+
+        def claim(keys: List[str]) -> bool:
+            with lock:
+                if any([key in claimed for key in keys]):
+                    return False
+                claimed.update(keys)
+                return True
+
+        def post_keys(post) -> List[str]:
+            # A crosspost points back at its original, and a link post is the same story wherever it is shared
+            keys = [getattr(post.object, 'crosspost_parent', None) or f't3_{post.object.id}']
+            if not getattr(post.object, 'is_self', True):
+                keys.append(post.object.url)
+            return keys
+
+        def run(subreddit: str) -> List[Summary]:
+            summaries = []
+            if mode in ['news', 'both']:
+                editor = Editor(self.post_reader, self.data_dir)
+                posts = [post for post in self.post_reader.get_posts(subreddit, limit) if claim(post_keys(post))]
+                posts = editor.duplicates.collapse(posts)
+                summaries += editor.complete_promts(editor.build_prompts(posts), 5)
+                tokens.append(editor.total_tokens)
+            if mode in ['research', 'both']:
+                researcher = self.new_researcher(self.researcher.paper_text)
+                for paper in researcher.discover_papers(subreddit, limit):
+                    if not claim([f'arxiv:{paper.id}']):
+                        continue
+                    summary = researcher.read_paper(paper.id, metadata=paper, rules=rules)
+                    if summary != None:
+                        summaries.append(summary)
+                researcher.report_duplicates()
+                tokens.append(researcher.total_tokens + researcher.summarizer.total_tokens)
+            return summaries
+
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(run, subreddits))
+        print(f'Tokens: {sum(tokens)}')
+
+        if combined:
+            summaries = [summary for result in results for summary in result]
+            return self.post_to_medium(summaries, f'Reddit News: r/{", r/".join(subreddits)}')
+        return [self.post_to_medium(result, f'Reddit News: r/{subreddit}') for subreddit, result in zip(subreddits, results)]
+
     def post_to_medium(self, summaries: List[Summary], title: str):
         today = datetime.date.today().strftime("%Y-%m-%d")
         content = f"\
@@ -67,12 +212,19 @@ class RedditNews:
             text = summary.text.replace('\n', '<br>')
             content += f"<h3><a href='{summary.url}'>{summary.title}</a></h3><p>{text}</p>"
 
-        post = self.medium.create_post(
-            user_id=self.medium_user_id,
-            title=title,
-            content=content,
-            content_format='html',
-            publish_status='public'
-        )
+        if self.dry_run:
+            print(f'Dry run, not posting {title}:\n{content}')
+            return '', ''
+
+        if self.medium_user_id == None:
+            self.medium_user_id = self.medium.get_current_user()['id']
+        with telemetry.span('medium_publish', title=title, summaries=len(summaries)):
+            post = self.medium.create_post(
+                user_id=self.medium_user_id,
+                title=title,
+                content=content,
+                content_format='html',
+                publish_status='public'
+            )
 
         return post['url'], post['id']
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+class Span:
+    name: str
+    attrs: dict
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.seconds = 0.0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+# Times each stage of the pipeline and keeps totals of what it costs.
+# Spans go to a JSONL trace file as they finish
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trace = None
+        self.stages = {}
+
+    def open(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.trace = open(path, 'a', encoding='utf-8', buffering=1024 * 64)
+
+    def close(self):
+        if self.trace != None:
+            self.trace.close()
+            self.trace = None
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        span = Span(name, attrs)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.record(span)
+
+    def record(self, span: Span):
+        with self.lock:
+            stage = self.stages.setdefault(span.name, {
+                "calls": 0,
+                "seconds": 0.0,
+                "errors": 0,
+                "retries": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0
+            })
+            stage["calls"] += 1
+            stage["seconds"] += span.seconds
+            stage["errors"] += 1 if 'error' in span.attrs else 0
+            stage["retries"] += span.attrs.get('retries', 0)
+            stage["prompt_tokens"] += span.attrs.get('prompt_tokens', 0)
+            stage["completion_tokens"] += span.attrs.get('completion_tokens', 0)
+            if self.trace != None:
+                self.trace.write(json.dumps({
+                    "span": span.name,
+                    "start": span.start,
+                    "seconds": span.seconds,
+                    "thread": threading.current_thread().name,
+                    **span.attrs
+                }) + '\n')
+
+    def prometheus(self) -> str:
+        lines = []
+        metrics = [
+            ('calls', 'reddit_news_stage_calls_total'),
+            ('seconds', 'reddit_news_stage_seconds_total'),
+            ('errors', 'reddit_news_stage_errors_total'),
+            ('retries', 'reddit_news_stage_retries_total'),
+            ('prompt_tokens', 'reddit_news_stage_prompt_tokens_total'),
+            ('completion_tokens', 'reddit_news_stage_completion_tokens_total')
+        ]
+        with self.lock:
+            for key, metric in metrics:
+                lines.append(f'# TYPE {metric} counter')
+                for name, stage in self.stages.items():
+                    lines.append(f'{metric}{{stage="{name}"}} {stage[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def save_snapshot(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+
+    def summary(self) -> str:
+        lines = [f'{"stage":<20}{"calls":>8}{"seconds":>10}{"errors":>8}{"prompt":>10}{"completion":>12}']
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda s: s[1]["seconds"], reverse=True)
+            for name, stage in stages:
+                lines.append(f'{name:<20}{stage["calls"]:>8}{stage["seconds"]:>10.2f}{stage["errors"]:>8}'
+                    f'{stage["prompt_tokens"]:>10}{stage["completion_tokens"]:>12}')
+        return '\n'.join(lines)
+
+telemetry = Telemetry()
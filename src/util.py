@@ -1,7 +1,22 @@
+from contextlib import contextmanager
+import sqlite3
+
 def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
         return infile.read()
 
 def save_file(filepath, content):
     with open(filepath, 'w', encoding='utf-8') as outfile:
-        outfile.write(content)
\ No newline at end of file
+        outfile.write(content)
+
+@contextmanager
+def connect_db(path):
+    # A connection per call keeps this safe to use from several threads and processes,
+    # sqlite serializes the writers
+    db = sqlite3.connect(path, timeout=30)
+    db.row_factory = sqlite3.Row
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()